@@ -0,0 +1,212 @@
+import hashlib
+import json
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+# --- Response cache metrics (exposed on the backend's /metrics endpoint) ---
+CACHE_HITS_TOTAL = Counter(
+    'response_cache_hits_total',
+    'Responses served from the response cache',
+    ['endpoint']
+)
+CACHE_MISSES_TOTAL = Counter(
+    'response_cache_misses_total',
+    'Responses that had to be computed because they were not cached',
+    ['endpoint']
+)
+CACHE_EVICTIONS_TOTAL = Counter(
+    'response_cache_evictions_total',
+    'Entries removed from the response cache',
+    ['reason'] # lru, ttl or invalidated
+)
+
+
+def make_key(endpoint, **params):
+    """Builds a stable cache key from the endpoint and its normalized query parameters."""
+    return endpoint + ":" + json.dumps(params, sort_keys=True, default=str)
+
+
+def make_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Checks an If-None-Match header against an ETag, accepting lists, weak tags and '*'."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+class MemoryBackend:
+    """In-process LRU store with a per-entry TTL."""
+
+    def __init__(self, max_entries=512, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, entry = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                CACHE_EVICTIONS_TOTAL.labels(reason="ttl").inc()
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                CACHE_EVICTIONS_TOTAL.labels(reason="lru").inc()
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self, is_stale):
+        """Drops every entry for which is_stale(entry) is true, returning how many were dropped."""
+        with self._lock:
+            stale_keys = [key for key, (_, entry) in self._entries.items() if is_stale(entry)]
+            for key in stale_keys:
+                del self._entries[key]
+        return len(stale_keys)
+
+
+class RedisBackend:
+    """Shared store for running several backend replicas; expiry is left to Redis."""
+
+    def __init__(self, url, ttl=300, prefix="fitbit:response-cache:"):
+        import redis  # Only needed when CACHE_BACKEND=redis
+        self._client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _redis_key(self, key):
+        return self.prefix + hashlib.sha1(key.encode()).hexdigest()
+
+    def get(self, key):
+        raw = self._client.get(self._redis_key(key))
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, entry):
+        self._client.setex(self._redis_key(key), self.ttl, pickle.dumps(entry))
+
+    def delete(self, key):
+        self._client.delete(self._redis_key(key))
+
+
+class ResponseCache:
+    """Caches encoded responses and drops them when ingestion rewrites days they cover.
+
+    Ingestion records every (user_id, date) it writes in ingested_days. The caller polls
+    that table whenever poll_due() says so and hands the rows to apply_watermarks(); an
+    entry is stale as soon as one of its users has a day in the entry's time range that
+    was ingested after it was built.
+    """
+
+    def __init__(self, backend, poll_interval=5.0):
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self._ingested = {}  # user_id -> {date: ingested_at}
+        self._latest = {}  # user_id -> latest ingested_at of any of their days
+        self._watermark = None  # Latest ingested_at seen for anyone
+        self._next_poll = 0.0
+        self._lock = threading.Lock()
+
+    def poll_due(self):
+        """Returns (True, since) at most once per poll interval, (False, None) otherwise.
+
+        The caller should then load the ingested_days rows with ingested_at >= since
+        (all rows when since is None) and pass them to apply_watermarks.
+        """
+        with self._lock:
+            if time.monotonic() < self._next_poll:
+                return False, None
+            self._next_poll = time.monotonic() + self.poll_interval
+            return True, self._watermark
+
+    def apply_watermarks(self, rows, since):
+        """Records newly ingested (user_id, date, ingested_at) rows and drops overlapping entries."""
+        # Rows are loaded with ingested_at >= since, so a day committed with the same
+        # timestamp as the last poll is not missed; days already known are skipped.
+        changed = set()
+        with self._lock:
+            for user_id, day, ingested_at in rows:
+                days = self._ingested.setdefault(user_id, {})
+                if days.get(day) == ingested_at:
+                    continue
+                days[day] = ingested_at
+                changed.add((user_id, day))
+                if user_id not in self._latest or ingested_at > self._latest[user_id]:
+                    self._latest[user_id] = ingested_at
+                if self._watermark is None or ingested_at > self._watermark:
+                    self._watermark = ingested_at
+        if changed and since is not None and hasattr(self.backend, "invalidate"):
+            dropped = self.backend.invalidate(lambda entry: self._overlaps(entry, changed))
+            CACHE_EVICTIONS_TOTAL.labels(reason="invalidated").inc(dropped)
+
+    @staticmethod
+    def _overlaps(entry, days):
+        return any(user_id in entry["user_ids"] and entry["start"] <= day <= entry["end"] for user_id, day in days)
+
+    def _is_stale(self, entry):
+        """An entry is stale if one of its users had a day in its range ingested after it was built."""
+        watermark = entry["watermark"]
+        for user_id in entry["user_ids"]:
+            latest = self._latest.get(user_id)
+            if latest is None or (watermark is not None and latest <= watermark):
+                continue
+            for day, ingested_at in self._ingested[user_id].items():
+                if entry["start"] <= day <= entry["end"] and (watermark is None or ingested_at > watermark):
+                    return True
+        return False
+
+    def get(self, endpoint, key):
+        entry = self.backend.get(key)
+        if entry is not None and self._is_stale(entry):
+            # Shared backends cannot be swept on poll, so stale entries are caught on read
+            self.backend.delete(key)
+            CACHE_EVICTIONS_TOTAL.labels(reason="invalidated").inc()
+            entry = None
+        if entry is None:
+            CACHE_MISSES_TOTAL.labels(endpoint=endpoint).inc()
+        else:
+            CACHE_HITS_TOTAL.labels(endpoint=endpoint).inc()
+        return entry
+
+    def watermark(self):
+        """The latest ingested_at seen so far; take it before building a response and pass it to put."""
+        with self._lock:
+            return self._watermark
+
+    def put(self, key, response, user_ids, start, end, watermark):
+        """Stores an encoded response covering user_ids over the dates start..end.
+
+        watermark is the one taken before the response was built, so days ingested while it
+        was being built still make the entry stale.
+        """
+        entry = {
+            "body": response.body,
+            "media_type": response.media_type,
+            "headers": {k: v for k, v in response.headers.items() if k.lower().startswith("x-")},
+            "etag": make_etag(response.body),
+            "user_ids": frozenset(user_ids),
+            "start": start,
+            "end": end,
+            "watermark": watermark,
+        }
+        self.backend.set(key, entry)
+        return entry
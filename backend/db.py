@@ -0,0 +1,268 @@
+import queue
+import threading
+import time
+from contextlib import AsyncExitStack, ExitStack, asynccontextmanager, contextmanager
+
+import psycopg2
+from psycopg2 import extras, sql
+from prometheus_client import Gauge, Histogram
+from starlette.concurrency import run_in_threadpool
+
+# --- Connection pool metrics (exposed on the backend's /metrics endpoint) ---
+DB_POOL_IN_USE = Gauge(
+    'db_pool_connections_in_use',
+    'Number of pooled database connections currently checked out by a request'
+)
+DB_POOL_IDLE = Gauge(
+    'db_pool_connections_idle',
+    'Number of open database connections waiting in the pool'
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    'db_pool_acquire_wait_seconds',
+    'Time a request waited to acquire a pooled database connection',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection could be acquired within the acquire timeout."""
+
+
+class UndefinedTable(Exception):
+    """Raised when a query references a table that does not exist yet (SQLSTATE 42P01)."""
+
+
+class ConnectionPool:
+    """A small thread-safe psycopg2 connection pool.
+
+    Connections are opened lazily up to max_size and handed back to the pool
+    after each request instead of being closed, so requests skip the TCP and
+    auth handshake. Callers wait at most acquire_timeout seconds for a free slot.
+    """
+
+    def __init__(self, dsn, min_size=2, max_size=10, acquire_timeout=5.0):
+        if min_size > max_size:
+            raise ValueError("min_size must not be larger than max_size")
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+        for _ in range(min_size):
+            self._idle.put(psycopg2.connect(dsn))
+        DB_POOL_IDLE.set(self._idle.qsize())
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for the duration of the with-block."""
+        if self._closed:
+            raise PoolTimeout("Connection pool is closed")
+
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+            raise PoolTimeout(f"No database connection available after {self.acquire_timeout}s")
+
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+        DB_POOL_IN_USE.inc()
+        DB_POOL_IDLE.set(self._idle.qsize())
+
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
+            DB_POOL_IN_USE.dec()
+            DB_POOL_IDLE.set(self._idle.qsize())
+            self._slots.release()
+
+    def _checkout(self):
+        # Reuse the most recently returned connection, skipping any the server dropped
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return psycopg2.connect(self.dsn)
+            if not conn.closed:
+                return conn
+
+    def _checkin(self, conn):
+        if conn.closed:
+            return
+        if self._closed:
+            conn.close()
+            return
+        try:
+            # End the implicit read transaction so the next request starts clean
+            conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    def close(self):
+        """Closes all idle connections; checked-out ones are closed on return."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        DB_POOL_IDLE.set(0)
+
+
+class SyncDatabase:
+    """Runs queries through the psycopg2 ConnectionPool on Starlette's threadpool.
+
+    Every query holds a threadpool worker for its whole database round trip.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def _fetchall(self, query, params, dict_rows):
+        cursor_factory = extras.RealDictCursor if dict_rows else None
+        with self.pool.connection() as conn, conn.cursor(cursor_factory=cursor_factory) as cur:
+            try:
+                cur.execute(query, params)
+            except psycopg2.errors.UndefinedTable as e:
+                raise UndefinedTable(str(e)) from e
+            return cur.fetchall()
+
+    async def fetchall(self, query, params=None, dict_rows=False):
+        """Runs a query and returns all rows, as tuples or as dicts."""
+        return await run_in_threadpool(self._fetchall, query, params, dict_rows)
+
+    def _open_stream(self, query, params, batch_size):
+        resources = ExitStack()
+        conn = resources.enter_context(self.pool.connection())
+
+        def batches():
+            with resources:
+                # A named cursor keeps the result set on the server; we only ever hold one batch
+                with conn.cursor(name="data_stream") as cur:
+                    cur.itersize = batch_size
+                    cur.execute(query, params)
+                    while True:
+                        rows = cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield rows
+
+        stream = batches()
+
+        def close():
+            # Closing the generator first closes the cursor, then rolls back and checks the
+            # connection in; the stack only still holds it if the generator never started
+            stream.close()
+            resources.close()
+
+        return stream, close
+
+    async def open_stream(self, query, params, batch_size):
+        """Checks out a connection and returns (batches, close) for a server-side cursor.
+
+        The connection is returned to the pool when batches is exhausted or when close is called.
+        """
+        return await run_in_threadpool(self._open_stream, query, params, batch_size)
+
+    async def close(self):
+        self.pool.close()
+
+
+def to_psycopg3(composable):
+    """Converts a psycopg2.sql composable into its psycopg (3) equivalent.
+
+    Queries are written once with psycopg2.sql and only translated for the async driver.
+    """
+    from psycopg import sql as sql3
+    if isinstance(composable, sql.Composed):
+        return sql3.Composed([to_psycopg3(part) for part in composable.seq])
+    if isinstance(composable, sql.SQL):
+        return sql3.SQL(composable.string)
+    if isinstance(composable, sql.Identifier):
+        return sql3.Identifier(*composable.strings)
+    if isinstance(composable, sql.Literal):
+        return sql3.Literal(composable.wrapped)
+    if isinstance(composable, sql.Placeholder):
+        return sql3.Placeholder(composable.name) if composable.name else sql3.Placeholder()
+    return composable
+
+
+class AsyncDatabase:
+    """Runs queries on a psycopg (3) AsyncConnectionPool without tying up threadpool workers."""
+
+    def __init__(self, dsn, min_size=2, max_size=10, acquire_timeout=5.0):
+        # Only needed when DB_DRIVER=psycopg, so sync deployments do not require psycopg 3
+        from psycopg_pool import AsyncConnectionPool
+        self.pool = AsyncConnectionPool(dsn, min_size=min_size, max_size=max_size,
+                                        timeout=acquire_timeout, open=False)
+
+    async def open(self):
+        await self.pool.open()
+        DB_POOL_IDLE.set(self.pool.get_stats().get("pool_available", 0))
+
+    @asynccontextmanager
+    async def connection(self):
+        from psycopg_pool import PoolTimeout as Psycopg3PoolTimeout
+        start = time.perf_counter()
+        try:
+            async with self.pool.connection() as conn:
+                DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+                DB_POOL_IN_USE.inc()
+                try:
+                    yield conn
+                finally:
+                    DB_POOL_IN_USE.dec()
+        except Psycopg3PoolTimeout as e:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+            raise PoolTimeout(str(e)) from e
+        finally:
+            DB_POOL_IDLE.set(self.pool.get_stats().get("pool_available", 0))
+
+    async def fetchall(self, query, params=None, dict_rows=False):
+        """Runs a query and returns all rows, as tuples or as dicts."""
+        from psycopg import errors as errors3
+        from psycopg.rows import dict_row, tuple_row
+        async with self.connection() as conn:
+            async with conn.cursor(row_factory=dict_row if dict_rows else tuple_row) as cur:
+                try:
+                    await cur.execute(to_psycopg3(query), params)
+                except errors3.UndefinedTable as e:
+                    raise UndefinedTable(str(e)) from e
+                return await cur.fetchall()
+
+    async def open_stream(self, query, params, batch_size):
+        """Checks out a connection and returns (batches, close) for a server-side cursor.
+
+        The connection is returned to the pool when batches is exhausted or when close is called.
+        """
+        resources = AsyncExitStack()
+        conn = await resources.enter_async_context(self.connection())
+
+        async def batches():
+            async with resources:
+                async with conn.cursor(name="data_stream") as cur:
+                    cur.itersize = batch_size
+                    await cur.execute(to_psycopg3(query), params)
+                    while True:
+                        rows = await cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield rows
+
+        stream = batches()
+
+        async def close():
+            await stream.aclose()
+            await resources.aclose()
+
+        return stream, close
+
+    async def close(self):
+        await self.pool.close()
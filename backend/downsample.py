@@ -0,0 +1,51 @@
+import numpy as np
+
+
+def lttb_indices(x, y, n_out):
+    """Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the indices of the n_out points of the series (x, y) that best keep
+    its visual shape, always including the first and last point. x must be sorted.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # Split the inner points 1..n-2 into n_out-2 buckets; bucket i is [edges[i], edges[i+1])
+    every = (n - 2) / (n_out - 2)
+    edges = (np.arange(n_out - 1) * every).astype(np.int64) + 1
+    edges[-1] = n - 1
+    counts = np.diff(edges)
+
+    # The third triangle vertex for bucket i is the average point of bucket i+1
+    # (or the last point for the final bucket), which is known up front.
+    avg_x = np.add.reduceat(x[:-1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:-1], edges[:-1]) / counts
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        bx = x[lo:hi]
+        by = y[lo:hi]
+        # Twice the triangle area between the previous pick, each candidate and the next bucket's average
+        area = np.abs((x[a] - next_x[i]) * (by - y[a]) - (x[a] - bx) * (next_y[i] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample_rows(rows, max_points, time_index=0, value_index=1):
+    """Applies LTTB to a list of time-ordered row tuples, keeping at most max_points rows."""
+    if len(rows) <= max_points:
+        return rows
+    x = np.fromiter((row[time_index].timestamp() for row in rows), dtype=np.float64, count=len(rows))
+    y = np.fromiter((row[value_index] for row in rows), dtype=np.float64, count=len(rows))
+    return [rows[i] for i in lttb_indices(x, y, max_points)]
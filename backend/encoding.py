@@ -0,0 +1,205 @@
+import io
+
+import numpy as np
+import orjson
+from starlette.responses import Response
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow output is optional, the other formats work without it
+    pa = None
+
+# Media types /data can answer with, picked from the request's Accept header
+ROWS_JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.fitbit.columnar+json"
+PACKED_FLOAT64 = "application/vnd.fitbit.float64"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+SUPPORTED_MEDIA_TYPES = [ROWS_JSON, COLUMNAR_JSON, PACKED_FLOAT64] + ([ARROW_STREAM] if pa else [])
+
+# Pagination and resolution details travel in headers for the binary formats, so the browser must be allowed to read them
+PAGINATION_HEADERS = ["X-Page", "X-Has-More", "X-Next-Cursor", "X-Columns", "X-Row-Count",
+                      "X-Resolution", "X-Resolution-Table"]
+
+
+def negotiate(accept):
+    """Returns the supported media type the client prefers, defaulting to row JSON."""
+    if not accept:
+        return ROWS_JSON
+    candidates = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if media_type in SUPPORTED_MEDIA_TYPES and quality > 0:
+            candidates.append((-quality, position, media_type))
+    return min(candidates)[2] if candidates else ROWS_JSON
+
+
+def resolution_headers(resolution):
+    """Headers naming the interval and table a response was read at, given {"interval", "table"}."""
+    return {"X-Resolution": resolution["interval"], "X-Resolution-Table": resolution["table"]}
+
+
+def encode_rows_json(rows, page, has_more, next_cursor, resolution, stats=()):
+    """Encodes rows as the default {"data": [{"time", "value"}, ...]} JSON shape.
+
+    Requested stats follow (time, value, user_id) in each row and are added to each point by name.
+    """
+    # Rename 'avg_value' to 'value' for frontend consistency
+    if stats:
+        data = [{"time": row[0], "value": row[1], **dict(zip(stats, row[3:]))} for row in rows]
+    else:
+        data = [{"time": row[0], "value": row[1]} for row in rows]
+    body = orjson.dumps({
+        "data": data,
+        "page": page,
+        "has_more": has_more,
+        "next_cursor": next_cursor,
+        "resolution": resolution
+    })
+    return Response(content=body, media_type=ROWS_JSON, headers=resolution_headers(resolution))
+
+
+def to_columns(rows, value_index=1):
+    """Turns (time, value, ...) rows into epoch-millisecond int64 and float64 arrays."""
+    count = len(rows)
+    times = np.fromiter((row[0].timestamp() * 1000 for row in rows), dtype=np.float64, count=count)
+    values = np.fromiter((row[value_index] for row in rows), dtype=np.float64, count=count)
+    return times.astype(np.int64), values
+
+
+def stat_columns(rows, stats):
+    """Turns the stats following (time, value, user_id) in each row into float64 arrays, NaN where missing."""
+    return {stat: np.array([row[3 + i] for row in rows], dtype=np.float64) for i, stat in enumerate(stats)}
+
+
+def encode_columnar(rows, media_type, page, has_more, next_cursor, resolution, stats=()):
+    """Encodes rows in one of the columnar formats and wraps them in a Response."""
+    times, values = to_columns(rows)
+    extra = stat_columns(rows, stats)
+    headers = {
+        "X-Page": str(page),
+        "X-Has-More": "true" if has_more else "false",
+        "X-Columns": ",".join(["time", "value", *stats]),
+        "X-Row-Count": str(len(rows)),
+        **resolution_headers(resolution),
+    }
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+
+    if media_type == COLUMNAR_JSON:
+        body = orjson.dumps(
+            {"time": times, "value": values, **extra, "page": page, "has_more": has_more, "next_cursor": next_cursor,
+             "resolution": resolution},
+            option=orjson.OPT_SERIALIZE_NUMPY
+        )
+    elif media_type == PACKED_FLOAT64:
+        # One little-endian float64 array of X-Row-Count entries per column, in X-Columns order
+        body = b"".join(column.astype("<f8").tobytes() for column in (times, values, *extra.values()))
+    elif media_type == ARROW_STREAM:
+        table = pa.table({
+            "time": pa.array(times, type=pa.timestamp("ms", tz="UTC")),
+            "value": pa.array(values, type=pa.float64()),
+            **{stat: pa.array(column, type=pa.float64()) for stat, column in extra.items()},
+        })
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        body = sink.getvalue().to_pybytes()
+    else:
+        raise ValueError(f"Unsupported columnar media type: {media_type}")
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+# --- Streaming export formats (used by /data/stream) ---
+# Each format turns batches of (time, value, user_id) rows into bytes through
+# start(), encode(rows) and finish(), so the same encoders serve sync and async cursors.
+
+class NdjsonStream:
+    media_type = "application/x-ndjson"
+
+    def start(self):
+        return b""
+
+    def encode(self, rows):
+        """One JSON object per line for each row."""
+        return b"".join(orjson.dumps({"time": row[0], "user_id": row[2], "value": row[1]}) + b"\n" for row in rows)
+
+    def finish(self):
+        return b""
+
+
+class CsvStream:
+    media_type = "text/csv"
+
+    def start(self):
+        return b"time,user_id,value\n"
+
+    def encode(self, rows):
+        return "".join(f"{row[0].isoformat()},{row[2]},{row[1]!r}\n" for row in rows).encode()
+
+    def finish(self):
+        return b""
+
+
+class ArrowStream:
+    """An Arrow IPC stream with one record batch per fetched batch."""
+    media_type = ARROW_STREAM
+
+    def __init__(self):
+        self.schema = pa.schema([
+            ("time", pa.timestamp("ms", tz="UTC")),
+            ("user_id", pa.int64()),
+            ("value", pa.float64()),
+        ])
+        self._buffer = io.BytesIO()
+        self._writer = None
+
+    def _drain(self):
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def start(self):
+        self._writer = pa.ipc.new_stream(self._buffer, self.schema)
+        return self._drain()
+
+    def encode(self, rows):
+        times, values = to_columns(rows)
+        user_ids = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+        self._writer.write_batch(pa.record_batch([
+            pa.array(times, type=pa.timestamp("ms", tz="UTC")),
+            pa.array(user_ids),
+            pa.array(values),
+        ], schema=self.schema))
+        return self._drain()
+
+    def finish(self):
+        self._writer.close()
+        return self._drain()
+
+
+STREAM_FORMATS = {"ndjson": NdjsonStream, "csv": CsvStream, "arrow": ArrowStream}
+
+
+def iter_stream(stream, batches):
+    """Encodes the batches of a sync cursor."""
+    yield stream.start()
+    for rows in batches:
+        yield stream.encode(rows)
+    yield stream.finish()
+
+
+async def aiter_stream(stream, batches):
+    """Encodes the batches of an async cursor."""
+    yield stream.start()
+    async for rows in batches:
+        yield stream.encode(rows)
+    yield stream.finish()
@@ -1,15 +1,67 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, Header, HTTPException, Query
+from collections import defaultdict
 from fastapi.middleware.cors import CORSMiddleware
 import os
-import psycopg2
+import time
+import base64
+import orjson
+import json
+from contextlib import asynccontextmanager
 from psycopg2 import sql
-from psycopg2 import extras
-from datetime import datetime, timedelta
-from typing import List
-from prometheus_client import Counter, generate_latest, REGISTRY
-from starlette.responses import Response
+from datetime import date as date_type, datetime, timedelta
+from typing import List, Optional
+from prometheus_client import Counter, Histogram, generate_latest, REGISTRY
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from db import AsyncDatabase, ConnectionPool, PoolTimeout, SyncDatabase, UndefinedTable
+from downsample import downsample_rows
+from resolution import format_interval, native_granularity, plan_resolution
+from impute import METRIC_CONFIG
+from encoding import (ROWS_JSON, PAGINATION_HEADERS, STREAM_FORMATS, SUPPORTED_MEDIA_TYPES, ARROW_STREAM,
+                      negotiate, encode_rows_json, encode_columnar, resolution_headers, iter_stream, aiter_stream)
+from cache import MemoryBackend, RedisBackend, ResponseCache, make_key, etag_matches
 
-app = FastAPI()
+DATABASE_URL = os.getenv("DATABASE_URL")
+# "psycopg2" runs queries on the threadpool, "psycopg" uses the async psycopg 3 driver end to end
+DB_DRIVER = os.getenv("DB_DRIVER", "psycopg2")
+# Connection pool sizing, shared by all endpoints
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "5"))
+# Response cache for /data and /zones: "memory" (per process) or "redis" (shared, needs CACHE_REDIS_URL)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "512"))
+CACHE_POLL_SECONDS = float(os.getenv("CACHE_POLL_SECONDS", "5"))
+# Default number of points per series a time series request may read; picks the rollup table
+DATA_POINT_BUDGET = int(os.getenv("DATA_POINT_BUDGET", "20000"))
+
+database = None
+response_cache = None
+
+@asynccontextmanager
+async def lifespan(app):
+    """Opens the shared connection pool and response cache on startup and closes the pool on shutdown."""
+    global database, response_cache
+    if DB_DRIVER == "psycopg":
+        database = AsyncDatabase(DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_ACQUIRE_TIMEOUT)
+        await database.open()
+    else:
+        database = SyncDatabase(
+            ConnectionPool(DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_ACQUIRE_TIMEOUT)
+        )
+    if CACHE_BACKEND == "redis":
+        backend = RedisBackend(CACHE_REDIS_URL, ttl=CACHE_TTL_SECONDS)
+    else:
+        backend = MemoryBackend(max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+    response_cache = ResponseCache(backend, poll_interval=CACHE_POLL_SECONDS)
+    yield
+    await database.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS middleware to allow requests from the frontend
 app.add_middleware(
@@ -18,10 +70,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=PAGINATION_HEADERS,
 )
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-
 # --- Create a Prometheus metric ---
 # This creates a counter that we can increment.
 DATA_REQUESTS_TOTAL = Counter(
@@ -30,58 +81,190 @@ DATA_REQUESTS_TOTAL = Counter(
     ['metric_name'] # We can add labels to distinguish metrics
 )
 
+# Per-request timings, labelled by route and by the table and metric the request resolved to,
+# so the resolution tier behind slow requests is visible. Routes that read no time series use "none".
+# Metric labels come from metric_label, so client-supplied names cannot add label sets.
+REQUEST_LATENCY_SECONDS = Histogram(
+    'backend_request_latency_seconds',
+    'Time from receiving a request until its response starts',
+    ['route', 'table', 'metric'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+DB_QUERY_SECONDS = Histogram(
+    'backend_db_query_seconds',
+    'Time spent executing a query and fetching its rows, including waiting for a pooled connection',
+    ['route', 'table', 'metric'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+SERIALIZATION_SECONDS = Histogram(
+    'backend_serialization_seconds',
+    'Time spent downsampling and encoding rows into the response body',
+    ['route', 'table', 'metric'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+ROWS_RETURNED = Histogram(
+    'backend_rows_returned',
+    'Rows fetched from the database per request',
+    ['route', 'table', 'metric'],
+    buckets=(0, 10, 100, 1000, 5000, 20000, 50000, 100000, 500000, 1000000, 5000000)
+)
+
+def metric_label(metric):
+    """The metric as a Prometheus label value: itself if METRIC_CONFIG knows it, "other" otherwise."""
+    return metric if metric in METRIC_CONFIG else "other"
+
 # --- Create the /metrics endpoint ---
 @app.get("/metrics")
 def get_metrics():
     """Exposes Prometheus metrics."""
     return Response(media_type="text/plain", content=generate_latest(REGISTRY))
 
-def get_table_for_interval(start_date, end_date):
-    """Determines the appropriate aggregate table based on the time range."""
-    duration = end_date - start_date
-    print(f"Query duration: {duration}")
-
-    if duration <= timedelta(days=2):
-        print("Using table: fitbit_data (raw)")
-        return "fitbit_data", "value"
-    elif duration <= timedelta(days=30):
-        print("Using table: data_1m")
-        return "data_1m", "avg_value"
-    elif duration <= timedelta(days=365):
-        print("Using table: data_1h")
-        return "data_1h", "avg_value"
-    else: # For queries longer than a year
-        print("Using table: data_1d")
-        return "data_1d", "avg_value"
-    
+@app.exception_handler(PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    """Answers 503 when no pooled database connection was free within the acquire timeout."""
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+@app.middleware("http")
+async def observe_request_latency(request: Request, call_next):
+    """Records request latency; data handlers set request.state.series_labels to (table, metric)."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    # For streamed exports this is the time to the first byte, the body is still being sent
+    route = request.scope.get("route")
+    table, metric = getattr(request.state, "series_labels", ("none", "none"))
+    REQUEST_LATENCY_SECONDS.labels(route.path if route else "unmatched", table, metric).observe(
+        time.perf_counter() - start
+    )
+    return response
+
+async def fetch_rows(labels, query, params):
+    """Runs a time series query, recording its DB time and row count under labels (route, table, metric)."""
+    start = time.perf_counter()
+    rows = await database.fetchall(query, params)
+    DB_QUERY_SECONDS.labels(*labels).observe(time.perf_counter() - start)
+    ROWS_RETURNED.labels(*labels).observe(len(rows))
+    return rows
+
+async def serialize(labels, encode, *args):
+    """Runs encode(*args) on the threadpool, recording how long the encoding itself took."""
+    def timed():
+        start = time.perf_counter()
+        response = encode(*args)
+        SERIALIZATION_SECONDS.labels(*labels).observe(time.perf_counter() - start)
+        return response
+    # Encoding a full response is CPU work, keep it off the event loop
+    return await run_in_threadpool(timed)
+
+def observe_batches(labels, batches):
+    """Wraps a sync or async stream of row batches, recording fetch time and rows once it is exhausted."""
+    def record(fetch_seconds, row_count):
+        DB_QUERY_SECONDS.labels(*labels).observe(fetch_seconds)
+        ROWS_RETURNED.labels(*labels).observe(row_count)
+
+    if hasattr(batches, "__aiter__"):
+        async def timed_async():
+            fetch_seconds, row_count = 0.0, 0
+            start = time.perf_counter()
+            async for rows in batches:
+                fetch_seconds += time.perf_counter() - start
+                row_count += len(rows)
+                yield rows
+                start = time.perf_counter()
+            record(fetch_seconds + time.perf_counter() - start, row_count)
+        return timed_async()
+
+    def timed():
+        fetch_seconds, row_count = 0.0, 0
+        start = time.perf_counter()
+        for rows in batches:
+            fetch_seconds += time.perf_counter() - start
+            row_count += len(rows)
+            yield rows
+            start = time.perf_counter()
+        record(fetch_seconds + time.perf_counter() - start, row_count)
+    return timed()
+
+# Rollup columns behind each stats= value; a raw row is a bucket of one sample
+STAT_COLUMNS = {"count": "sample_count", "sum": "sum_value", "min": "min_value", "max": "max_value"}
+STATS_PATTERN = "^(count|sum|min|max)(,(count|sum|min|max))*$"
+
+def parse_stats(stats):
+    """Splits the stats= parameter into a list without duplicates, keeping the requested order."""
+    return list(dict.fromkeys(stats.split(','))) if stats else []
+
+def stat_columns_sql(resolution, stats):
+    """The ', col, ...' select list that appends the requested stats after (time, value, user_id)."""
+    columns = []
+    for stat in stats:
+        if resolution.table == "fitbit_data":
+            columns.append(sql.SQL("1::bigint") if stat == "count" else sql.Identifier("value"))
+        else:
+            columns.append(sql.Identifier(STAT_COLUMNS[stat]))
+    return sql.SQL("").join(sql.SQL(", {}").format(column) for column in columns)
+
+def resolution_info(resolution):
+    """The part of a plan_resolution() result that is returned to the client."""
+    return {"interval": resolution.interval, "table": resolution.table}
+
 @app.get("/zones")
-def get_zones(date: str, user_id: int):
+async def get_zones(request: Request, date: str, user_id: int, if_none_match: Optional[str] = Header(None)):
     # The date will come from the frontend as YYYY-MM-DDTHH:mm, we only need the date part.
     query_date = date.split('T')[0]
-    
-    conn = psycopg2.connect(DATABASE_URL)
-    zones = {}
-    with conn.cursor() as cur:
-        cur.execute(
+    try:
+        zone_date = date_type.fromisoformat(query_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use ISO format for date.")
+    request.state.series_labels = ("daily_zones", "heart_rate_zones")
+
+    async def build():
+        zones = {}
+        rows = await fetch_rows(
+            ("/zones", "daily_zones", "heart_rate_zones"),
             "SELECT zone_name, min_hr, max_hr FROM daily_zones WHERE user_id = %s AND date = %s",
-            (user_id, query_date)
+            (user_id, zone_date)
         )
-        for row in cur.fetchall():
+        for row in rows:
             zone_name, min_hr, max_hr = row
             # Format for easy use on the frontend
             zones[zone_name] = {"min": min_hr, "max": max_hr}
-    conn.close()
-    return zones
+        return Response(content=orjson.dumps(zones), media_type="application/json")
 
-@app.get("/data")
-def get_data(start_date: str, end_date: str,  metric: str, 
-              user_ids: str, # Accept a comma-separated string of user IDs
-              page: int = 1, # Add pagination parameters with default values
-              page_size: int = 20000 # Number of data points per page
-              ):
-    # Increment the counter each time this endpoint is called, with the metric name as a label
-    DATA_REQUESTS_TOTAL.labels(metric_name=metric).inc()
+    # Zone definitions are immutable per date, so they stay cached until that day is re-ingested
+    key = make_key("zones", user_id=user_id, date=query_date)
+    return await cached_response("zones", key, [user_id], zone_date, zone_date, if_none_match, build)
+
+async def load_ingestion_watermarks(since):
+    """Returns (user_id, date, ingested_at) for the days ingestion wrote at or after since."""
+    try:
+        if since is None:
+            return await database.fetchall("SELECT user_id, date, ingested_at FROM ingested_days;")
+        return await database.fetchall(
+            "SELECT user_id, date, ingested_at FROM ingested_days WHERE ingested_at >= %s;", (since,)
+        )
+    except UndefinedTable:
+        # Ingestion has not created its tables yet, so there is nothing to invalidate
+        return []
+
+async def cached_response(endpoint, key, user_ids, start, end, if_none_match, build):
+    """Serves a response from the cache, awaiting build() and storing its result on a miss.
+
+    start and end are the dates the response covers; it is invalidated when ingestion
+    writes any of those days for one of user_ids. Matching If-None-Match gets a 304.
+    """
+    due, since = response_cache.poll_due()
+    if due:
+        response_cache.apply_watermarks(await load_ingestion_watermarks(since), since)
+    entry = response_cache.get(endpoint, key)
+    if entry is None:
+        watermark = response_cache.watermark()
+        entry = response_cache.put(key, await build(), user_ids, start, end, watermark)
+    headers = {**entry["headers"], "ETag": entry["etag"], "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, entry["etag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type=entry["media_type"], headers=headers)
 
+def parse_range_params(start_date, end_date, user_ids):
+    """Parses the ISO start/end dates and the comma-separated user_ids shared by the data endpoints."""
     try:
         start_dt = datetime.fromisoformat(start_date)
         end_dt = datetime.fromisoformat(end_date)
@@ -89,140 +272,370 @@ def get_data(start_date: str, end_date: str,  metric: str,
         user_id_list = [int(uid.strip()) for uid in user_ids.split(',')]
     except (ValueError, TypeError):
         raise HTTPException(status_code=400, detail="Invalid date or user_id format. Use ISO format for date.")
+    return start_dt, end_dt, user_id_list
+
+def encode_cursor(time, user_id):
+    """Builds an opaque pagination cursor from the last (time, user_id) returned."""
+    raw = json.dumps([time.isoformat(), user_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor):
+    """Reverses encode_cursor, returning the (time, user_id) to continue after."""
+    try:
+        time_str, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(time_str), int(user_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+@app.get("/data")
+async def get_data(request: Request, start_date: str, end_date: str,  metric: str, 
+              user_ids: str, # Accept a comma-separated string of user IDs
+              page: int = 1, # Add pagination parameters with default values
+              page_size: int = 20000, # Number of data points per page
+              cursor: Optional[str] = None, # next_cursor from the previous page, takes precedence over page
+              max_points: Optional[int] = Query(None, ge=3), # Downsample each user's series to at most this many points
+              point_budget: int = Query(DATA_POINT_BUDGET, ge=1), # Points per series the chosen table may return over the range
+              stats: Optional[str] = Query(None, pattern=STATS_PATTERN), # Comma-separated bucket stats to add: count,sum,min,max
+              accept: Optional[str] = Header(None), # Selects row JSON (default) or one of the columnar formats
+              if_none_match: Optional[str] = Header(None)
+              ):
+    # Increment the counter each time this endpoint is called, with the metric name as a label
+    DATA_REQUESTS_TOTAL.labels(metric_name=metric_label(metric)).inc()
+
+    start_dt, end_dt, user_id_list = parse_range_params(start_date, end_date, user_ids)
     
-    table_name, value_column = get_table_for_interval(start_dt, end_dt)
-    offset = (page - 1) * page_size
-
-    conn = psycopg2.connect(DATABASE_URL)
-    with conn.cursor() as cur:
-        #using psycopg2.sql to safely format identifiers like table and column names
-        # Use = ANY() to efficiently query for multiple user IDs
-        # Fetch one extra row to check if more data exists
-        query = sql.SQL("""
-            SELECT time, {value_col} FROM {table}
-            WHERE user_id = ANY(%s) AND metric_name = %s AND time BETWEEN %s AND %s
-            ORDER BY time
-            LIMIT %s OFFSET %s;
-        """).format(
-            value_col=sql.Identifier(value_column),
-            table=sql.Identifier(table_name)
-        )
-        cur.execute(query, (user_id_list, metric, start_date, end_date, page_size + 1, offset))
-        data = cur.fetchall()
-    conn.close()
+    resolution = plan_resolution(start_dt, end_dt, [metric], point_budget)
+    request.state.series_labels = (resolution.table, metric_label(metric))
+    media_type = negotiate(accept)
+    stat_list = parse_stats(stats)
+
+    async def build():
+        if max_points:
+            return await get_downsampled_data(resolution, user_id_list, metric, start_dt, end_dt,
+                                              max_points, media_type, stat_list)
+        return await get_page_data(resolution, user_id_list, metric, start_dt, end_dt,
+                                   page, page_size, cursor, media_type, stat_list)
+
+    # Keyed by the resolved table rather than the budget, so budgets that resolve alike share entries
+    key = make_key(
+        "data", metric=metric, user_ids=sorted(set(user_id_list)), start=start_dt.isoformat(), end=end_dt.isoformat(),
+        page=page, page_size=page_size, cursor=cursor, max_points=max_points, media_type=media_type,
+        table=resolution.table, stats=stat_list
+    )
+    return await cached_response("data", key, user_id_list, start_dt.date(), end_dt.date(), if_none_match, build)
+
+async def get_page_data(resolution, user_id_list, metric, start_dt, end_dt, page, page_size, cursor, media_type, stats):
+    """Returns one page of rows, continuing after cursor when given and at page otherwise."""
+    # Keyset pagination: continue strictly after the last (time, user_id) seen so every
+    # page is an index range scan. Old clients that only send page still get OFFSET paging.
+    if cursor:
+        after_time, after_user_id = decode_cursor(cursor)
+        keyset_filter = sql.SQL("AND (time, user_id) > (%s, %s)")
+        keyset_params = (after_time, after_user_id)
+        offset = 0
+    else:
+        keyset_filter = sql.SQL("")
+        keyset_params = ()
+        offset = (page - 1) * page_size
+
+    #using psycopg2.sql to safely format identifiers like table and column names
+    # Use = ANY() to efficiently query for multiple user IDs
+    # Fetch one extra row to check if more data exists
+    query = sql.SQL("""
+        SELECT time, {value_col}, user_id{stat_cols} FROM {table}
+        WHERE user_id = ANY(%s) AND metric_id = (SELECT metric_id FROM metrics WHERE metric_name = %s)
+            AND time BETWEEN %s AND %s
+        {keyset_filter}
+        ORDER BY time, user_id
+        LIMIT %s OFFSET %s;
+    """).format(
+        value_col=sql.Identifier(resolution.value_column),
+        stat_cols=stat_columns_sql(resolution, stats),
+        table=sql.Identifier(resolution.table),
+        keyset_filter=keyset_filter
+    )
+    labels = ("/data", resolution.table, metric_label(metric))
+    data = await fetch_rows(
+        labels, query, (user_id_list, metric, start_dt, end_dt, *keyset_params, page_size + 1, offset)
+    )
     # Check if there are more pages
     has_more = len(data) > page_size
     # Trim the extra row before sending the response
     response_data = data[:page_size]
-    # Rename 'avg_value' to 'value' for frontend consistency
-    return {
-        "data": [{"time": row[0], "value": row[1]} for row in response_data],
-        "page": page,
-        "has_more": has_more
-    }
+    next_cursor = encode_cursor(response_data[-1][0], response_data[-1][2]) if has_more else None
+    return await serialize(labels, data_response, response_data, media_type, page, has_more, next_cursor,
+                           resolution_info(resolution), stats)
+
+def data_response(rows, media_type, page, has_more, next_cursor, resolution, stats):
+    """Shapes /data rows as row JSON or as one of the negotiated columnar formats."""
+    if media_type != ROWS_JSON:
+        return encode_columnar(rows, media_type, page, has_more, next_cursor, resolution, stats)
+    return encode_rows_json(rows, page, has_more, next_cursor, resolution, stats)
+
+async def get_downsampled_data(resolution, user_id_list, metric, start_dt, end_dt, max_points, media_type, stats):
+    """Returns the whole range in one response, LTTB-downsampled to max_points per user."""
+    query = sql.SQL("""
+        SELECT time, {value_col}, user_id{stat_cols} FROM {table}
+        WHERE user_id = ANY(%s) AND metric_id = (SELECT metric_id FROM metrics WHERE metric_name = %s)
+            AND time BETWEEN %s AND %s
+        ORDER BY user_id, time;
+    """).format(
+        value_col=sql.Identifier(resolution.value_column),
+        stat_cols=stat_columns_sql(resolution, stats),
+        table=sql.Identifier(resolution.table)
+    )
+    labels = ("/data", resolution.table, metric_label(metric))
+    data = await fetch_rows(labels, query, (user_id_list, metric, start_dt, end_dt))
+    return await serialize(labels, downsample_response, data, max_points, media_type, resolution_info(resolution),
+                           stats)
+
+def downsample_response(data, max_points, media_type, resolution, stats):
+    # Downsample each user's series on its own so one user's peaks cannot hide another's
+    series = defaultdict(list)
+    for row in data:
+        series[row[2]].append(row)
+    response_data = []
+    for rows in series.values():
+        response_data.extend(downsample_rows(rows, max_points))
+    response_data.sort(key=lambda row: (row[0], row[2]))
+    return data_response(response_data, media_type, 1, False, None, resolution, stats)
+
+@app.get("/data/stream")
+async def stream_data(request: Request, start_date: str, end_date: str, metric: str,
+                      user_ids: str, # Accept a comma-separated string of user IDs
+                      format: str = Query("ndjson", pattern="^(ndjson|csv|arrow)$"),
+                      batch_size: int = Query(5000, ge=100, le=100000), # Rows fetched from the server-side cursor at a time
+                      point_budget: int = Query(DATA_POINT_BUDGET, ge=1) # Points per series the chosen table may return over the range
+                      ):
+    """Streams a whole range straight from a server-side cursor, so memory stays flat for any range size."""
+    DATA_REQUESTS_TOTAL.labels(metric_name=metric_label(metric)).inc()
+
+    start_dt, end_dt, user_id_list = parse_range_params(start_date, end_date, user_ids)
+    if format == "arrow" and ARROW_STREAM not in SUPPORTED_MEDIA_TYPES:
+        raise HTTPException(status_code=406, detail="Arrow output is not available on this server.")
+
+    resolution = plan_resolution(start_dt, end_dt, [metric], point_budget)
+    table_name, value_column = resolution.table, resolution.value_column
+    request.state.series_labels = (table_name, metric_label(metric))
+    query = sql.SQL("""
+        SELECT time, {value_col}, user_id FROM {table}
+        WHERE user_id = ANY(%s) AND metric_id = (SELECT metric_id FROM metrics WHERE metric_name = %s)
+            AND time BETWEEN %s AND %s
+        ORDER BY time, user_id;
+    """).format(
+        value_col=sql.Identifier(value_column),
+        table=sql.Identifier(table_name)
+    )
+
+    # Borrow the connection before the response starts so an exhausted pool still answers 503.
+    # It is returned when the stream finishes, or by the background task if it never started.
+    batches, close = await database.open_stream(query, (user_id_list, metric, start_dt, end_dt), batch_size)
+    batches = observe_batches(("/data/stream", table_name, metric_label(metric)), batches)
+    stream = STREAM_FORMATS[format]()
+    body = aiter_stream(stream, batches) if hasattr(batches, "__aiter__") else iter_stream(stream, batches)
+    return StreamingResponse(body, media_type=stream.media_type, headers=resolution_headers(resolution_info(resolution)),
+                             background=BackgroundTask(close))
+
+@app.get("/data/batch")
+async def get_batch_data(request: Request, start_date: str, end_date: str,
+                         user_ids: str, # Accept a comma-separated string of user IDs
+                         metrics: str, # Accept a comma-separated string of metric names
+                         max_points: Optional[int] = Query(None, ge=3), # Downsample each series to at most this many points
+                         point_budget: int = Query(DATA_POINT_BUDGET, ge=1) # Points per series the chosen table may return over the range
+                         ):
+    """Returns every (user_id, metric) series of a cohort view with one query."""
+    start_dt, end_dt, user_id_list = parse_range_params(start_date, end_date, user_ids)
+    metric_list = [m.strip() for m in metrics.split(',') if m.strip()]
+    if not metric_list:
+        raise HTTPException(status_code=400, detail="At least one metric is required.")
+    for metric in metric_list:
+        DATA_REQUESTS_TOTAL.labels(metric_name=metric_label(metric)).inc()
+
+    # All series come from one table, planned for the finest-grained metric requested
+    resolution = plan_resolution(start_dt, end_dt, metric_list, point_budget)
+    table_name, value_column = resolution.table, resolution.value_column
+    # One request covers several metrics, so they share a single label value
+    series_metric = metric_label(metric_list[0]) if len(metric_list) == 1 else "multiple"
+    request.state.series_labels = (table_name, series_metric)
+
+    # Ordering by series keeps each (user_id, metric) contiguous and time-sorted for grouping below
+    query = sql.SQL("""
+        SELECT user_id, m.metric_name, time, {value_col} FROM {table} t
+        JOIN metrics m ON m.metric_id = t.metric_id
+        WHERE user_id = ANY(%s) AND m.metric_name = ANY(%s) AND time BETWEEN %s AND %s
+        ORDER BY user_id, t.metric_id, time;
+    """).format(
+        value_col=sql.Identifier(value_column),
+        table=sql.Identifier(table_name)
+    )
+    labels = ("/data/batch", table_name, series_metric)
+    data = await fetch_rows(labels, query, (user_id_list, metric_list, start_dt, end_dt))
+    return await serialize(labels, batch_response, data, user_id_list, metric_list, max_points,
+                           resolution_info(resolution))
+
+def batch_response(data, user_id_list, metric_list, max_points, resolution):
+    # Every requested pair gets a series, even when it has no data in the range
+    series = {(user_id, metric): [] for user_id in user_id_list for metric in metric_list}
+    for user_id, metric_name, time, value in data:
+        series[(user_id, metric_name)].append((time, value))
+
+    response = []
+    for (user_id, metric), rows in series.items():
+        if max_points:
+            rows = downsample_rows(rows, max_points)
+        response.append({
+            "user_id": user_id,
+            "metric": metric,
+            "data": [{"time": row[0], "value": row[1]} for row in rows]
+        })
+    return Response(content=orjson.dumps({"series": response, "resolution": resolution}), media_type=ROWS_JSON,
+                    headers=resolution_headers(resolution))
+
+@app.get("/gaps")
+async def get_gaps(request: Request, start_date: str, end_date: str, metric: str,
+                   user_ids: str, # Accept a comma-separated string of user IDs
+                   if_none_match: Optional[str] = Header(None)
+                   ):
+    """Returns the runs of missing buckets of each user's series within the range, from the data_gaps index.
+
+    Gaps are kept by ingestion at the metric's METRIC_CONFIG granularity and only between
+    ingested points, clipped here to [start_date, end_date).
+    """
+    start_dt, end_dt, user_id_list = parse_range_params(start_date, end_date, user_ids)
+    if METRIC_CONFIG.get(metric, {}).get("table") != "fitbit_data":
+        raise HTTPException(status_code=400, detail=f"No gap index for metric '{metric}'.")
+    request.state.series_labels = ("data_gaps", metric)
+
+    async def build():
+        rows = await fetch_rows(("/gaps", "data_gaps", metric), """
+            SELECT user_id, GREATEST(gap_start, %s), LEAST(gap_end, %s) FROM data_gaps
+            WHERE user_id = ANY(%s) AND metric_name = %s AND gap_end > %s AND gap_start < %s
+            ORDER BY user_id, gap_start;
+        """, (start_dt, end_dt, user_id_list, metric, start_dt, end_dt))
+        return await serialize(("/gaps", "data_gaps", metric), gaps_response, rows, user_id_list, metric)
+
+    key = make_key("gaps", metric=metric, user_ids=sorted(set(user_id_list)),
+                   start=start_dt.isoformat(), end=end_dt.isoformat())
+    return await cached_response("gaps", key, user_id_list, start_dt.date(), end_dt.date(), if_none_match, build)
+
+def gaps_response(rows, user_id_list, metric):
+    granularity = native_granularity(metric)
+    series = {user_id: [] for user_id in user_id_list}
+    for user_id, gap_start, gap_end in rows:
+        series[user_id].append((gap_start, gap_end))
+
+    response = []
+    for user_id, gaps in series.items():
+        # Gaps never overlap, so the missing time is the sum of their clipped lengths
+        missing = sum((gap_end - gap_start for gap_start, gap_end in gaps), timedelta(0))
+        response.append({
+            "user_id": user_id,
+            "missing_seconds": missing.total_seconds(),
+            "missing_buckets": -(-missing // granularity),
+            "gaps": [{"start": gap_start, "end": gap_end, "buckets": -(-(gap_end - gap_start) // granularity)}
+                     for gap_start, gap_end in gaps]
+        })
+    body = {"metric": metric, "granularity": format_interval(granularity), "series": response}
+    return Response(content=orjson.dumps(body), media_type="application/json")
 
 @app.get("/users")
-def get_all_users():
+async def get_all_users():
     """Returns a list of all users in the database."""
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=extras.RealDictCursor)
-    with conn.cursor() as cur:
-        cur.execute("SELECT user_id, name FROM users ORDER BY name;")
-        users = cur.fetchall()
-    conn.close()
+    users = await database.fetchall("SELECT user_id, name FROM users ORDER BY name;", dict_rows=True)
     return users
 
 @app.get("/adherence")
-def get_adherence_report():
+async def get_adherence_report():
     report = {}
-    conn = psycopg2.connect(DATABASE_URL)
+    # 1. Get all users and check for recent data uploads
+    all_users = await database.fetchall(
+        "SELECT user_id, name, email, last_seen, fitbit_connected_status FROM users;", dict_rows=True
+    )
+
+    for user in all_users:
+        flags = []
+        report[user['user_id']] = {
+            "name": user['name'],
+            "email": user['email'],
+            "flags": flags
+        }
     
-    with conn.cursor(cursor_factory=extras.DictCursor) as cur:
-        # 1. Get all users and check for recent data uploads
-        cur.execute("SELECT user_id, name, email, last_seen, fitbit_connected_status FROM users;")
-        all_users = cur.fetchall()
-
-        for user in all_users:
-            flags = []
-            report[user['user_id']] = {
-                "name": user['name'],
-                "email": user['email'],
-                "flags": flags
-            }
-        
-        for user in all_users:
-            # Check if last_seen is older than 48 hours
-            if user['last_seen'] and (datetime.now(user['last_seen'].tzinfo) - user['last_seen']) > timedelta(hours=48):
-                report[user['user_id']]['flags'].append("No data uploaded in last 48 hours")
-        # cur.execute("""
-        #     SELECT user_id, MAX(time) FROM fitbit_data
-        #     GROUP BY user_id
-        #     HAVING MAX(time) < NOW() - INTERVAL '48 hours';
-        # """)
-
-        # 2. Check for overall wear time adherence (< 70%)
-        # assuming a fixed study duration for all users for wear time calculation.
-        # here we look at 30 days study which have 1440 minutes. A real implementation 
-        # would use each user's enrollment_date. since intraday_heart_rate is with 1sec frequency 
-        # its more reliable to check for wear time adherence
-        # cur.execute("""
-        #     SELECT 
-        #         user_id, 
-        #         (COUNT(DISTINCT date_trunc('minute', time)) / (30.0 * 1440.0)) * 100 AS wear_percentage 
-        #     FROM fitbit_data
-        #     WHERE metric_name = 'intraday_heart_rate'
-        #     GROUP BY user_id;
-        # """)
-
-        cur.execute("""
-            SELECT
-                u.user_id,
-                -- Calculate percentage based on days since enrollment
-                (
-                    CAST(COUNT(DISTINCT date_trunc('minute', fd.time)) AS REAL) /
-                    -- Avoid division by zero and handle new users
-                    NULLIF((CURRENT_DATE - u.enrollment_date + 1) * 1440, 0)
-                ) * 100 AS wear_percentage
-            FROM
-                users u
-            LEFT JOIN
-                fitbit_data fd ON u.user_id = fd.user_id AND fd.metric_name = 'intraday_heart_rate'
-            GROUP BY
-                u.user_id, u.enrollment_date;
-        """)
-        wear_time_data = cur.fetchall()
-
-        for row in wear_time_data:
-            # if row['wear_percentage'] < 70 and row['user_id'] in report:
-            if row['wear_percentage'] is not None and row['wear_percentage'] < 70:
-                report[row['user_id']]['flags'].append(f"Low Wear Time ({row['wear_percentage']:.1f}%)")
-
-        # a. Get users who haven't connected their Fitbit
-        cur.execute("SELECT user_id, name, email FROM users WHERE fitbit_connected_status = FALSE;")
-        for user in cur.fetchall():
-            # report[user[0]] = {"name": user[1], "email": user[2], "flags": ["No Token"]}
-            report[user['user_id']]['flags'].append("No Token")
-        
-        # Create a dictionary to hold sleep day counts
-        good_sleep_days = {}
-        #here assuming now() is 2022-07-05 to test
-        cur.execute("""
-            SELECT user_id, COUNT(*) as sleep_count
-            FROM sleep_summary
-            WHERE date >= (DATE '2022-07-05' - INTERVAL '7 days') AND "minutes_asleep" > 240
-            GROUP BY user_id;
-        """)
-        #generally it should be
-        # cur.execute("""
-        #     SELECT user_id, COUNT(*) as sleep_count
-        #     FROM sleep_summary
-        #     WHERE date >= NOW() - INTERVAL '7 days' AND "minutes_asleep" > 240
-        #     GROUP BY user_id;
-        # """)
-        for row in cur.fetchall():
-            good_sleep_days[row['user_id']] = row['sleep_count']
-            sleep_count = good_sleep_days.get(row['user_id'], 0)
-            if sleep_count < 5:
-                report[row['user_id']]['flags'].append(f"Low Sleep Upload ({sleep_count}/7 days with >4hr sleep)")
-
-    conn.close()
+    for user in all_users:
+        # Check if last_seen is older than 48 hours
+        if user['last_seen'] and (datetime.now(user['last_seen'].tzinfo) - user['last_seen']) > timedelta(hours=48):
+            report[user['user_id']]['flags'].append("No data uploaded in last 48 hours")
+    # cur.execute("""
+    #     SELECT user_id, MAX(time) FROM fitbit_data
+    #     GROUP BY user_id
+    #     HAVING MAX(time) < NOW() - INTERVAL '48 hours';
+    # """)
+
+    # 2. Check for overall wear time adherence (< 70%)
+    # assuming a fixed study duration for all users for wear time calculation.
+    # here we look at 30 days study which have 1440 minutes. A real implementation 
+    # would use each user's enrollment_date. since intraday_heart_rate is with 1sec frequency 
+    # its more reliable to check for wear time adherence
+    # cur.execute("""
+    #     SELECT 
+    #         user_id, 
+    #         (COUNT(DISTINCT date_trunc('minute', time)) / (30.0 * 1440.0)) * 100 AS wear_percentage 
+    #     FROM fitbit_data
+    #     WHERE metric_name = 'intraday_heart_rate'
+    #     GROUP BY user_id;
+    # """)
+
+    # Wear minutes per day are maintained by ingestion in daily_adherence, so this
+    # reads one small row per user-day instead of scanning fitbit_data
+    wear_time_data = await database.fetchall("""
+        SELECT
+            u.user_id,
+            -- Calculate percentage based on days since enrollment
+            (
+                CAST(COALESCE(SUM(da.wear_minutes), 0) AS REAL) /
+                -- Avoid division by zero and handle new users
+                NULLIF((CURRENT_DATE - u.enrollment_date + 1) * 1440, 0)
+            ) * 100 AS wear_percentage
+        FROM
+            users u
+        LEFT JOIN
+            daily_adherence da ON u.user_id = da.user_id
+        GROUP BY
+            u.user_id, u.enrollment_date;
+    """, dict_rows=True)
+
+    for row in wear_time_data:
+        # if row['wear_percentage'] < 70 and row['user_id'] in report:
+        if row['wear_percentage'] is not None and row['wear_percentage'] < 70:
+            report[row['user_id']]['flags'].append(f"Low Wear Time ({row['wear_percentage']:.1f}%)")
+
+    # a. Get users who haven't connected their Fitbit
+    disconnected_users = await database.fetchall(
+        "SELECT user_id, name, email FROM users WHERE fitbit_connected_status = FALSE;", dict_rows=True
+    )
+    for user in disconnected_users:
+        # report[user[0]] = {"name": user[1], "email": user[2], "flags": ["No Token"]}
+        report[user['user_id']]['flags'].append("No Token")
+    
+    # Create a dictionary to hold sleep day counts
+    good_sleep_days = {}
+    #here assuming now() is 2022-07-05 to test
+    sleep_data = await database.fetchall("""
+        SELECT user_id, COUNT(*) as sleep_count
+        FROM daily_adherence
+        WHERE date >= (DATE '2022-07-05' - INTERVAL '7 days') AND sleep_minutes > 240
+        GROUP BY user_id;
+    """, dict_rows=True)
+    #generally it should be
+    # cur.execute("""
+    #     SELECT user_id, COUNT(*) as sleep_count
+    #     FROM sleep_summary
+    #     WHERE date >= NOW() - INTERVAL '7 days' AND "minutes_asleep" > 240
+    #     GROUP BY user_id;
+    # """)
+    for row in sleep_data:
+        good_sleep_days[row['user_id']] = row['sleep_count']
+        sleep_count = good_sleep_days.get(row['user_id'], 0)
+        if sleep_count < 5:
+            report[row['user_id']]['flags'].append(f"Low Sleep Upload ({sleep_count}/7 days with >4hr sleep)")
+
     return report
\ No newline at end of file
@@ -0,0 +1,65 @@
+from collections import namedtuple
+from datetime import timedelta
+
+# impute.py is mounted next to the backend (see docker-compose.yml) and owns the per-metric granularities
+from impute import METRIC_CONFIG
+
+# Tables a time series can be read from, finest first, with the bucket width of each rollup
+TIERS = [
+    ("fitbit_data", "value", None),
+    ("data_1m", "avg_value", timedelta(minutes=1)),
+    ("data_1h", "avg_value", timedelta(hours=1)),
+    ("data_1d", "avg_value", timedelta(days=1)),
+]
+
+# Metrics missing from METRIC_CONFIG are assumed to be as dense as anything we ingest
+DEFAULT_GRANULARITY = timedelta(seconds=1)
+
+UNITS = {"second": timedelta(seconds=1), "minute": timedelta(minutes=1),
+         "hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+Resolution = namedtuple("Resolution", ["table", "value_column", "interval", "estimated_points"])
+
+
+def parse_interval(text):
+    """Turns an interval such as '1 minute' or '5 seconds' into a timedelta."""
+    count, unit = text.split()
+    return int(count) * UNITS[unit.rstrip("s")]
+
+
+def format_interval(step):
+    for unit, width in reversed(list(UNITS.items())):
+        if step % width == timedelta(0):
+            count = step // width
+            return f"{count} {unit}" if count == 1 else f"{count} {unit}s"
+    return f"{step.total_seconds()} seconds"
+
+
+def native_granularity(metric):
+    config = METRIC_CONFIG.get(metric)
+    return parse_interval(config["granularity"]) if config else DEFAULT_GRANULARITY
+
+
+def plan_resolution(start, end, metrics, point_budget):
+    """Picks the table to read [start, end] from so each series stays within point_budget points.
+
+    A tier's point estimate is the range divided by the coarser of its bucket width and
+    the metric's native granularity (the finest one when several metrics share a query).
+    The finest resolution within budget wins; when tiers tie on resolution, e.g. a daily
+    metric is daily in every table, the smaller rollup is read. If none fits, the
+    coarsest tier is used.
+    """
+    native = min(native_granularity(metric) for metric in metrics)
+    duration = max(end - start, timedelta(0))
+
+    candidates = []
+    for table, value_column, bucket in TIERS:
+        step = max(bucket or native, native)
+        candidates.append((step, Resolution(table, value_column, format_interval(step), duration // step + 1)))
+
+    within_budget = [(step, resolution) for step, resolution in candidates if resolution.estimated_points <= point_budget]
+    if not within_budget:
+        return candidates[-1][1]
+    finest = min(step for step, _ in within_budget)
+    # Tiers are ordered finest first, so the last one at this step is the cheapest to read
+    return [resolution for step, resolution in within_budget if step == finest][-1]
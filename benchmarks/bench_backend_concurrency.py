@@ -0,0 +1,68 @@
+# Fires concurrent /data requests at one or more running backends and compares
+# throughput and tail latency, e.g. the same image started with DB_DRIVER=psycopg2
+# on port 8000 and DB_DRIVER=psycopg on port 8001 against the same TimescaleDB:
+#   python benchmarks/bench_backend_concurrency.py http://localhost:8000 http://localhost:8001
+# Needs httpx (pip install httpx).
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import httpx
+import numpy as np
+
+
+def request_params(i, args):
+    # Shift every window by a few seconds so each request misses the response cache
+    start = datetime.fromisoformat(args.start) + timedelta(seconds=i)
+    end = start + timedelta(hours=args.hours)
+    return {
+        "start_date": start.isoformat(),
+        "end_date": end.isoformat(),
+        "metric": args.metric,
+        "user_ids": args.user_ids,
+        "page_size": args.page_size,
+    }
+
+
+async def run(base_url, args):
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        await client.get("/data", params=request_params(-1, args))  # Warm up the pool
+
+        async def one(i):
+            nonlocal errors
+            start = time.perf_counter()
+            response = await client.get("/data", params=request_params(i, args))
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return args.concurrency / elapsed, p50, p95, p99, errors
+
+
+async def main(args):
+    print(f"{args.concurrency} concurrent /data requests ({args.metric}, {args.hours}h windows)")
+    print(f"{'backend':<30} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for base_url in args.base_urls:
+        throughput, p50, p95, p99, errors = await run(base_url, args)
+        print(f"{base_url:<30} {throughput:>8.1f} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base_urls", nargs="+")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--metric", default="intraday_heart_rate")
+    parser.add_argument("--user-ids", default="1,2,3")
+    parser.add_argument("--start", default="2022-06-01T00:00:00")
+    parser.add_argument("--hours", type=int, default=6)
+    parser.add_argument("--page-size", type=int, default=2000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,47 @@
+# Compares encode time and payload size of the /data response formats.
+# Runs without a database: python benchmarks/bench_data_encoding.py [rows]
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+from encoding import (COLUMNAR_JSON, PACKED_FLOAT64, ARROW_STREAM, SUPPORTED_MEDIA_TYPES,  # noqa: E402
+                      encode_columnar, encode_rows_json)
+
+
+RESOLUTION = {"table": "fitbit_data", "interval": "1 second"}
+
+
+def make_rows(count):
+    # One page of 1-second heart rate as psycopg2 returns it: (time, value, user_id)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    values = np.random.default_rng(0).normal(75, 12, count)
+    return [(start + timedelta(seconds=i), float(values[i]), 1) for i in range(count)]
+
+
+def bench(label, encode, baseline=None, repeat=10):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = encode()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    ratios = f"   {best / baseline[0]:.2f}x the time, {len(body) / baseline[1]:.0%} of the size" if baseline else ""
+    print(f"{label:<40} {best * 1000:>9.2f} ms {len(body):>12,} bytes{ratios}")
+    return best, len(body)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rows = make_rows(count)
+    print(f"Encoding {count:,} rows (best of 10)")
+    # The default row JSON that /data returns without an Accept header
+    baseline = bench("application/json (rows)", lambda: encode_rows_json(rows, 1, True, None, RESOLUTION).body)
+    for media_type in (COLUMNAR_JSON, PACKED_FLOAT64, ARROW_STREAM):
+        if media_type not in SUPPORTED_MEDIA_TYPES:
+            print(f"{media_type:<40} skipped (pyarrow not installed)")
+            continue
+        bench(media_type, lambda: encode_columnar(rows, media_type, 1, True, None, RESOLUTION).body, baseline)
@@ -0,0 +1,91 @@
+# Compares the per-point tuple parsers in ingest.py with the columnar ones in columnar.py
+# on synthetic payloads shaped like wearipedia's, and the text and binary COPY encoders.
+# load_series takes SeriesBatches, so the tuple path is also timed with the rows_to_batches
+# conversion it needs before a binary COPY. That both parsers produce the same rows is
+# checked by tests/test_columnar.py. Runs wherever the ingestion requirements are installed,
+# no database needed:
+#   python benchmarks/bench_parsers.py [days]
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+# impute.py sits at the repository root here and next to the ingestion scripts in the container
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ingestion"))
+import ingest  # noqa: E402
+from columnar import rows_to_batches  # noqa: E402
+from loader import copy_buffer, series_copy_buffer  # noqa: E402
+
+USER_ID = 1
+
+
+def clock(seconds):
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def make_records(days):
+    # One payload per metric, a day per record as wearipedia returns them
+    rng = np.random.default_rng(0)
+    start = date(2024, 1, 1)
+    heart_rate, spo2, azm = [], [], []
+    for d in range(days):
+        day = (start + timedelta(days=d)).isoformat()
+        heart_rate.append({"heart_rate_day": [{
+            "activities-heart": [{"dateTime": day, "value": {}}],
+            "activities-heart-intraday": {"dataset": [
+                {"time": clock(s), "value": int(v)} for s, v in zip(range(86400), rng.integers(50, 160, 86400))
+            ]},
+        }]})
+        spo2.append({"dateTime": day, "minutes": [
+            {"minute": f"{day}T{clock(m * 60)}", "value": float(v)} for m, v in enumerate(rng.normal(97, 1, 480).round(1))
+        ]})
+        azm_minutes = []
+        for m in range(1440):
+            value = {"activeZoneMinutes": int(rng.integers(0, 3))}
+            # Types are only present on some minutes, and occasionally null
+            if m % 3 == 0:
+                value["fatBurnActiveZoneMinutes"] = 1
+            if m % 7 == 0:
+                value["cardioActiveZoneMinutes"] = None
+            azm_minutes.append({"minute": clock(m * 60), "value": value})
+        azm_minutes.append({"minute": clock(0), "value": {}})  # Skipped: empty value
+        azm.append({"activities-active-zone-minutes-intraday": [{"dateTime": day, "minutes": azm_minutes}]})
+    return {"heart_rate": heart_rate, "spo2": spo2, "azm": azm}
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    records = make_records(days)
+    pairs = [
+        ("heart_rate", ingest.parse_heart_rate, ingest.parse_heart_rate_columns),
+        ("spo2", ingest.parse_spo2, ingest.parse_spo2_columns),
+        ("azm", ingest.parse_azm, ingest.parse_azm_columns),
+    ]
+
+    print(f"Parsing {days} day(s) of synthetic data")
+    print(f"{'metric':<12} {'points':>10} {'tuples pts/s':>14} {'+batches pts/s':>16} {'columnar pts/s':>16} "
+          f"{'vs tuples':>10} {'vs +batches':>12}")
+    all_rows, all_batches = [], []
+    for name, tuple_parser, columnar_parser in pairs:
+        rows, tuple_time = timed(tuple_parser, records[name], USER_ID)
+        _, convert_time = timed(rows_to_batches, rows)
+        batches, columnar_time = timed(columnar_parser, records[name], USER_ID)
+        all_rows.extend(rows)
+        all_batches.extend(batches)
+        print(f"{name:<12} {len(rows):>10,} {len(rows) / tuple_time:>14,.0f} "
+              f"{len(rows) / (tuple_time + convert_time):>16,.0f} {len(rows) / columnar_time:>16,.0f} "
+              f"{tuple_time / columnar_time:>9.1f}x {(tuple_time + convert_time) / columnar_time:>11.1f}x")
+
+    text, text_time = timed(copy_buffer, all_rows)
+    binary, binary_time = timed(series_copy_buffer, all_batches)
+    print(f"COPY text   {text_time:>8.2f} s {len(text.getvalue()) / 1e6:>8.1f} MB")
+    print(f"COPY binary {binary_time:>8.2f} s {len(binary.getvalue()) / 1e6:>8.1f} MB")
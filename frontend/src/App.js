@@ -59,10 +59,12 @@ function App() {
 }, []);
   
   // 2. Function to fetch plot data
-  const fetchData = (plotKey, metric, page = 1) => {
+  const fetchData = (plotKey, metric, page = 1, cursor = null) => {
     if (!selectedParticipant) return;
 
-    const apiUrl = `http://localhost:8000/data?start_date=${startDate}&end_date=${endDate}&user_ids=${selectedParticipant.user_id}&metric=${metric}&page=${page}`;
+    // Continue from the cursor of the previous page when we have one, so later pages stay as fast as the first
+    const cursorParam = cursor ? `&cursor=${encodeURIComponent(cursor)}` : '';
+    const apiUrl = `http://localhost:8000/data?start_date=${startDate}&end_date=${endDate}&user_ids=${selectedParticipant.user_id}&metric=${metric}&page=${page}${cursorParam}`;
 
     if (metric === 'intraday_heart_rate') {
       const zonesApiUrl = `http://localhost:8000/zones?date=${startDate}&user_id=${selectedParticipant.user_id}`;
@@ -87,6 +89,7 @@ function App() {
                 queriedUserIds: selectedParticipant.user_id,
                 page: dataResponse.page,
                 hasMore: dataResponse.has_more,
+                nextCursor: dataResponse.next_cursor,
               };
               return updatedPlots;
             } else {
@@ -101,6 +104,7 @@ function App() {
                 queriedUserIds: selectedParticipant.user_id,
                 page: dataResponse.page,
                 hasMore: dataResponse.has_more,
+                nextCursor: dataResponse.next_cursor,
                 key: plotKey,
               }];
             }
@@ -128,6 +132,7 @@ function App() {
                 page: responseJson.page,
                 queriedUserIds: selectedParticipant.user_id,
                 hasMore: responseJson.has_more,
+                nextCursor: responseJson.next_cursor,
               };
               return updatedPlots;
             } else {
@@ -138,6 +143,7 @@ function App() {
                 page: responseJson.page,
                 queriedUserIds: selectedParticipant.user_id,
                 hasMore: responseJson.has_more,
+                nextCursor: responseJson.next_cursor,
                 key: plotKey,
               }];
             }
@@ -152,8 +158,8 @@ function App() {
     fetchData(plotKey, selectedMetric, 1);
   };
   
-  const handleLoadMore = (plotKey, metric, currentPage) => {
-    fetchData(plotKey, metric, currentPage + 1);
+  const handleLoadMore = (plotKey, metric, currentPage, nextCursor) => {
+    fetchData(plotKey, metric, currentPage + 1, nextCursor);
   };
 
   const handleParticipantSelect = (participant) => {
@@ -231,7 +237,7 @@ function App() {
                   </LineChart>
                 </ResponsiveContainer>
                 {plot.hasMore && (
-                <button onClick={() => handleLoadMore(plot.key, plot.metric, plot.page)} style={{ marginTop: '10px' }}>Load More</button>)}
+                <button onClick={() => handleLoadMore(plot.key, plot.metric, plot.page, plot.nextCursor)} style={{ marginTop: '10px' }}>Load More</button>)}
                 </>
                 ) : <p>No data found for this selection.</p>}
               </div>
@@ -1,7 +1,11 @@
 # impute.py
 import os
+import random
+import time
 import psycopg2
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from psycopg2 import sql
 
 # This dictionary defines how to handle each metric, including its time granularity and the table it lives in
@@ -84,16 +88,273 @@ METRIC_CONFIG = {
         'sleep': {
         'granularity': '1 day',
         'table': 'sleep_summary',
-        'value_col': 'minutesAsleep'
+        'value_col': 'minutes_asleep'
     }
 }
 
 
+# Number of (user, metric) imputation tasks run at once, each on its own connection
+IMPUTE_WORKERS = int(os.getenv("IMPUTE_WORKERS", "4"))
+# Attempts per task (at least one); lost connections, deadlocks and serialization failures are retried
+IMPUTE_ATTEMPTS = max(1, int(os.getenv("IMPUTE_ATTEMPTS", "3")))
+# Buckets before a series' watermark that every run gap-fills again, so gaps right after it interpolate
+IMPUTE_MARGIN_BUCKETS = int(os.getenv("IMPUTE_MARGIN_BUCKETS", "2"))
+# "sql" interpolates inside TimescaleDB; "numpy" reads each fitbit_data series into this process,
+# fills it with IMPUTE_STRATEGY (linear, locf or seasonal, see ingestion/fill.py) and writes the
+# imputed rows back with binary COPY. sleep_summary is always imputed in SQL.
+IMPUTE_ENGINE = os.getenv("IMPUTE_ENGINE", "sql")
+IMPUTE_STRATEGY = os.getenv("IMPUTE_STRATEGY", "linear")
+# numpy engine: gaps of more than this many buckets are left empty (0 fills every gap)
+IMPUTE_MAX_GAP_BUCKETS = int(os.getenv("IMPUTE_MAX_GAP_BUCKETS", "0"))
+# numpy engine, seasonal strategy: days before the window the time-of-day profile is built from
+IMPUTE_SEASONAL_DAYS = int(os.getenv("IMPUTE_SEASONAL_DAYS", "7"))
+
+
+def granularity_seconds(metric_name):
+    count, unit = METRIC_CONFIG[metric_name]['granularity'].split()
+    return int(count) * {"second": 1, "minute": 60, "hour": 3600, "day": 86400}[unit.rstrip("s")]
+
+
+def imputation_query(metric_name):
+    """The gapfill + interpolate statement for one (user, metric) series over a [start, finish) window."""
+    config = METRIC_CONFIG[metric_name]
+    # Dynamically build the query using the configuration
+    # This uses psycopg2.sql to safely insert identifiers
+    # --- This is the updated logic for the sleep_summary table ---
+    if config['table'] == 'sleep_summary':
+        return sql.SQL("""
+            WITH gapfilled AS (
+                SELECT
+                    time_bucket_gapfill({granularity}, date, %(start)s, %(finish)s) AS bucket,
+                    -- Impute both minutes and efficiency
+                    interpolate(AVG(minutes_asleep)) AS imputed_minutes,
+                    interpolate(AVG(efficiency)) AS imputed_efficiency
+                FROM sleep_summary
+                WHERE user_id = %(user_id)s AND date >= %(start)s AND date < %(finish)s
+                GROUP BY 1
+            )
+            INSERT INTO sleep_summary (date, user_id, minutes_asleep, efficiency, is_imputed)
+            SELECT
+                bucket, %(user_id)s, imputed_minutes, imputed_efficiency, TRUE
+            FROM gapfilled
+            -- Only insert rows where both values could be imputed
+            WHERE imputed_minutes IS NOT NULL AND imputed_efficiency IS NOT NULL
+            ON CONFLICT DO NOTHING;
+        """).format(
+            granularity=sql.Literal(config['granularity'])
+        )
+    # Standard execution for fitbit_data table
+    return sql.SQL("""
+        WITH gapfilled AS (
+            SELECT
+                time_bucket_gapfill({granularity}, time, %(start)s, %(finish)s) AS bucket,
+                interpolate(AVG({value_col})) AS imputed_value
+            FROM {table_name}
+            WHERE user_id = %(user_id)s AND metric_id = (SELECT metric_id FROM metrics WHERE metric_name = %(metric_name)s)
+                AND time >= %(start)s AND time < %(finish)s
+            GROUP BY 1
+        )
+        INSERT INTO {table_name} (time, user_id, metric_id, {value_col}, is_imputed)
+        SELECT bucket, %(user_id)s, (SELECT metric_id FROM metrics WHERE metric_name = %(metric_name)s), imputed_value, TRUE
+        FROM gapfilled
+        WHERE imputed_value IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    """).format(
+        granularity=sql.Literal(config['granularity']),
+        value_col=sql.Identifier(config['value_col']),
+        table_name=sql.Identifier(config['table'])
+    )
+
+
+def latest_real_time(cur, metric_name, user_id, since):
+    """Time of the newest ingested (not imputed) point of a series at or after since, or None."""
+    if METRIC_CONFIG[metric_name]['table'] == 'sleep_summary':
+        cur.execute("""
+            SELECT MAX(date) FROM sleep_summary
+            WHERE user_id = %s AND is_imputed = FALSE AND date >= %s;
+        """, (user_id, since.date()))
+        latest = cur.fetchone()[0]
+        return latest and datetime.combine(latest, datetime.min.time(), tzinfo=timezone.utc)
+    # Bounded below by the watermark, so only the chunks written since the last run are read
+    cur.execute("""
+        SELECT MAX(time) FROM fitbit_data
+        WHERE user_id = %s AND metric_id = (SELECT metric_id FROM metrics WHERE metric_name = %s)
+            AND is_imputed = FALSE AND time >= %s;
+    """, (user_id, metric_name, since))
+    return cur.fetchone()[0]
+
+
+def fill_window_sql(cur, metric_name, params):
+    cur.execute(imputation_query(metric_name), params)
+    return max(cur.rowcount, 0)
+
+
+def fill_window_numpy(cur, metric_name, params):
+    """The numpy engine: imputes one fitbit_data window in this process; returns the rows inserted."""
+    # numpy and the ingestion modules are only needed here, not by the backend
+    import numpy as np
+    from columnar import SeriesBatch
+    from fill import impute_series
+    from loader import load_series, read_series
+
+    def utc(value):
+        return np.datetime64(value.astimezone(timezone.utc).replace(tzinfo=None), "us")
+
+    step = np.timedelta64(granularity_seconds(metric_name), "s").astype("timedelta64[us]")
+    origin = params["start"]
+    if IMPUTE_STRATEGY == "seasonal":
+        origin -= timedelta(days=IMPUTE_SEASONAL_DAYS)
+    times, values = read_series(cur.connection, params["user_id"], metric_name, origin, params["finish"])
+    imputed_times, imputed_values = impute_series(times, values, utc(origin), utc(params["start"]), utc(params["finish"]),
+                                                  step, IMPUTE_STRATEGY, IMPUTE_MAX_GAP_BUCKETS)
+    # The batch times are UTC, and load_series casts them with the session time zone
+    cur.execute("SET LOCAL TIME ZONE 'UTC';")
+    return load_series(cur.connection, [SeriesBatch(params["user_id"], metric_name, imputed_times, imputed_values)],
+                       imputed=True)
+
+
+def fill_window(cur, metric_name, params):
+    if IMPUTE_ENGINE == "numpy" and METRIC_CONFIG[metric_name]['table'] == 'fitbit_data':
+        return fill_window_numpy(cur, metric_name, params)
+    return fill_window_sql(cur, metric_name, params)
+
+
+def indexed_gaps(cur, user_id, metric_name, start, finish):
+    """(first gap start, last gap end) of the indexed gaps of a fitbit_data series overlapping [start, finish).
+
+    Returns None when the index says the window has no gaps, and (start, finish) when the
+    index cannot be trusted yet because loads of this series still wait for the next refresh.
+    """
+    cur.execute("SELECT EXISTS (SELECT 1 FROM rollup_dirty WHERE user_id = %s AND metric_name = %s);",
+                (user_id, metric_name))
+    if cur.fetchone()[0]:
+        return start, finish
+    cur.execute("""
+        SELECT MIN(gap_start), MAX(gap_end) FROM data_gaps
+        WHERE user_id = %s AND metric_name = %s AND gap_end > %s AND gap_start < %s;
+    """, (user_id, metric_name, start, finish))
+    first, last = cur.fetchone()
+    return None if first is None else (first, last)
+
+
+def impute_window(cur, task):
+    """Gap-fills one series from its watermark up to its newest ingested point and advances the watermark.
+
+    Returns (imputed rows, first day of the window), or (0, None) when nothing was ingested since the last run.
+    """
+    user_id, metric_name, enrollment_date = task
+    step = timedelta(seconds=granularity_seconds(metric_name))
+    enrolled = datetime.combine(enrollment_date, datetime.min.time(), tzinfo=timezone.utc)
+
+    cur.execute("SELECT imputed_until FROM imputation_state WHERE user_id = %s AND metric_name = %s;",
+                (user_id, metric_name))
+    row = cur.fetchone()
+    watermark = row[0] if row else None
+    latest = latest_real_time(cur, metric_name, user_id, watermark or enrolled)
+    if latest is None or (watermark is not None and latest <= watermark):
+        return 0, None
+
+    # The watermark is the newest point the last run saw, so every gap before it is already filled;
+    # the window reaches back a few buckets so the first new gap interpolates from a known point
+    start = max(enrolled, watermark - IMPUTE_MARGIN_BUCKETS * step) if watermark else enrolled
+    finish = latest + step
+    params = {"start": start, "finish": finish, "user_id": user_id, "metric_name": metric_name}
+    if METRIC_CONFIG[metric_name]['table'] == 'sleep_summary':
+        params.update(start=start.date(), finish=finish.date())
+        gaps = (start, finish)
+    else:
+        # Only the span holding known holes is gap-filled, from the bucket before the first one
+        gaps = indexed_gaps(cur, user_id, metric_name, start, finish)
+        if gaps:
+            params.update(start=max(start, gaps[0] - step), finish=min(finish, gaps[1] + step))
+    imputed = fill_window(cur, metric_name, params) if gaps else 0
+    # Advanced in the same transaction as the imputed rows
+    cur.execute("""
+        INSERT INTO imputation_state (user_id, metric_name, imputed_until) VALUES (%s, %s, %s)
+        ON CONFLICT (user_id, metric_name) DO UPDATE
+        SET imputed_until = EXCLUDED.imputed_until, updated_at = clock_timestamp();
+    """, (user_id, metric_name, latest))
+    return imputed, start.date()
+
+
+def impute_task(connections, task):
+    """Imputes one (user_id, metric_name, enrollment_date) task on the calling thread's connection.
+
+    Every task commits on its own. Transient errors (lost connection, deadlock, serialization
+    failure) are retried with a jittered backoff. Returns (imputed rows, first day of the window).
+    """
+    # See run_imputation_engine for why this is not a module-level import
+    from instrumentation import STAGE_RETRIES, STAGE_ROWS, stage
+
+    user_id, metric_name, _ = task
+    for attempt in range(1, IMPUTE_ATTEMPTS + 1):
+        conn = connections.get()
+        try:
+            with stage("impute", metric_name):
+                with conn.cursor() as cur:
+                    imputed, start = impute_window(cur, task)
+                conn.commit()
+            break
+        except psycopg2.OperationalError as e:
+            if not conn.closed:
+                conn.rollback()
+            if attempt == IMPUTE_ATTEMPTS:
+                raise
+            STAGE_RETRIES.labels(stage="impute").inc()
+            delay = random.uniform(0.5, 1) * 2 ** attempt
+            print(f"-> Retrying '{metric_name}' for user {user_id} in {delay:.1f}s after: {e}")
+            time.sleep(delay)
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+    if start is None:
+        print(f"-> Nothing new to impute for '{metric_name}', user {user_id}.")
+    else:
+        STAGE_ROWS.labels(stage="impute", metric=metric_name).inc(imputed)
+        print(f"-> Imputation complete for '{metric_name}', user {user_id} from {start}. {imputed} new points were imputed.")
+    return imputed, start
+
+
+def refresh_user_summaries(conn, user_id, start_date, end_date):
+    with conn.cursor() as cur:
+        # Imputed heart rate and sleep rows count towards adherence, so refresh this user's daily summary
+        cur.execute("""
+            INSERT INTO daily_adherence (date, user_id, wear_minutes)
+            SELECT time::date, user_id, COUNT(DISTINCT date_trunc('minute', time))
+            FROM fitbit_data
+            WHERE user_id = %s AND metric_id = (SELECT metric_id FROM metrics WHERE metric_name = 'intraday_heart_rate')
+                AND time >= %s::date AND time < (%s::date + '1 day'::interval)
+            GROUP BY 1, 2
+            ON CONFLICT (date, user_id) DO UPDATE SET wear_minutes = EXCLUDED.wear_minutes;
+        """, (user_id, start_date, end_date))
+        cur.execute("""
+            INSERT INTO daily_adherence (date, user_id, sleep_minutes)
+            SELECT date, user_id, minutes_asleep FROM sleep_summary
+            WHERE user_id = %s AND date BETWEEN %s AND %s
+            ON CONFLICT (date, user_id) DO UPDATE SET sleep_minutes = EXCLUDED.sleep_minutes;
+        """, (user_id, start_date, end_date))
+
+        # Imputed rows can land on any day of the study, so cached backend responses for this user are dropped
+        cur.execute("""
+            INSERT INTO ingested_days (date, user_id)
+            SELECT day::date, %s FROM generate_series(%s::date, %s::date, INTERVAL '1 day') AS day
+            ON CONFLICT (date, user_id) DO UPDATE SET ingested_at = clock_timestamp();
+        """, (user_id, start_date, end_date))
+    conn.commit()
+
+
 #IMPUTATION
 def run_imputation_engine():
+    # Imported here because the backend imports this module for METRIC_CONFIG only; impute.py
+    # itself runs in the ingestion container, next to instrumentation.py and pipeline.py
+    from prometheus_client import push_to_gateway
+    from instrumentation import REGISTRY
+    from pipeline import ConnectionPerThread
+
     db_url = os.getenv("DATABASE_URL")
     conn = None
-    
+
     try:
         print("Connecting to database...")
         conn = psycopg2.connect(db_url)
@@ -103,67 +364,37 @@ def run_imputation_engine():
             # cur.execute("SELECT user_id, enrollment_date, NOW()::date as end_date FROM users;")
             cur.execute("SELECT user_id, enrollment_date, NOW()::date as end_date FROM users;")
             all_users = cur.fetchall()
-            print(f"Found {len(all_users)} users to process.")
-
-            # 2. Loop through each user
-            for user in all_users:
-                user_id, start_date, end_date = user
-                print(f"\n--- Processing User ID: {user_id} from {start_date} to {end_date} ---")
-
-                # 3. Loop through each metric in our configuration
-                for metric_name, config in METRIC_CONFIG.items():
-                    print(f"Imputing metric: '{metric_name}' with {config['granularity']} granularity...")
-                    
-                    # Dynamically build the query using the configuration
-                    # This uses psycopg2.sql to safely insert identifiers
-                    # --- This is the updated logic for the sleep_summary table ---
-                    if config['table'] == 'sleep_summary':
-                         imputation_query = sql.SQL("""
-                            WITH gapfilled AS (
-                                SELECT
-                                    time_bucket_gapfill({granularity}, date, %s, %s) AS bucket,
-                                    -- Impute both minutes and efficiency
-                                    interpolate(AVG(minutesAsleep)) AS imputed_minutes,
-                                    interpolate(AVG(efficiency)) AS imputed_efficiency
-                                FROM sleep_summary
-                                WHERE user_id = %s
-                                GROUP BY 1
-                            )
-                            INSERT INTO sleep_summary (date, user_id, minutesAsleep, efficiency, is_imputed)
-                            SELECT
-                                bucket, %s, imputed_minutes, imputed_efficiency, TRUE
-                            FROM gapfilled
-                            -- Only insert rows where both values could be imputed
-                            WHERE imputed_minutes IS NOT NULL AND imputed_efficiency IS NOT NULL
-                            ON CONFLICT DO NOTHING;
-                        """).format(
-                            granularity=sql.Literal(config['granularity'])
-                        )
-                         cur.execute(imputation_query, (start_date, end_date, user_id, user_id))
-                    else:
-                        # Standard execution for fitbit_data table
-                        imputation_query = sql.SQL("""
-                            WITH gapfilled AS (
-                                SELECT
-                                    time_bucket_gapfill({granularity}, time, %s, %s) AS bucket,
-                                    interpolate(AVG({value_col})) AS imputed_value
-                                FROM {table_name}
-                                WHERE user_id = %s AND metric_name = %s
-                                GROUP BY 1
-                            )
-                            INSERT INTO {table_name} (time, user_id, metric_name, {value_col}, is_imputed)
-                            SELECT bucket, %s, %s, imputed_value, TRUE
-                            FROM gapfilled
-                            WHERE imputed_value IS NOT NULL
-                            ON CONFLICT DO NOTHING;
-                        """).format(
-                            granularity=sql.Literal(config['granularity']),
-                            value_col=sql.Identifier(config['value_col']),
-                            table_name=sql.Identifier(config['table'])
-                        )
-                        cur.execute(imputation_query, (start_date, end_date, user_id, metric_name, user_id, metric_name))
-                    print(f"-> Imputation complete for '{metric_name}'. {cur.rowcount} new points were imputed.")
-                    conn.commit()
+        conn.commit()
+        print(f"Found {len(all_users)} users to process.")
+
+        # 2. One independent task per (user, metric), densest metrics first so the longest
+        # tasks start early and do not end up running alone at the end
+        tasks = [(user_id, metric_name, start_date)
+                 for user_id, start_date, _ in all_users for metric_name in METRIC_CONFIG]
+        tasks.sort(key=lambda task: granularity_seconds(task[1]))
+        remaining = {user_id: len(METRIC_CONFIG) for user_id, _, _ in all_users}
+        end_dates = {user_id: end_date for user_id, _, end_date in all_users}
+        # Earliest day each user's imputation wrote to, for the summaries refreshed afterwards
+        first_imputed = {}
+
+        # 3. Run them on a pool of threads, each with its own connection
+        with ConnectionPerThread(db_url) as connections, ThreadPoolExecutor(max_workers=IMPUTE_WORKERS) as pool:
+            futures = {pool.submit(impute_task, connections, task): task for task in tasks}
+            for future in as_completed(futures):
+                user_id, metric_name, _ = futures[future]
+                try:
+                    imputed, start = future.result()
+                    if imputed:
+                        first_imputed[user_id] = min(start, first_imputed.get(user_id, start))
+                except Exception:
+                    # The other tasks carry on; a failed one keeps its watermark and is retried on the next run
+                    print(f"-> Imputation failed for '{metric_name}', user {user_id}:")
+                    traceback.print_exc()
+                remaining[user_id] -= 1
+                if remaining[user_id] == 0:
+                    if user_id in first_imputed:
+                        refresh_user_summaries(conn, user_id, first_imputed[user_id], end_dates[user_id])
+                    print(f"--- User ID: {user_id} done ---")
 
     except Exception:
         print("A critical error occurred during imputation:")
@@ -171,6 +402,10 @@ def run_imputation_engine():
     finally:
         if conn:
             conn.close()
+        try:
+            push_to_gateway('pushgateway:9091', job='impute', registry=REGISTRY)
+        except Exception as e:
+            print(f"Failed to push metrics to Pushgateway: {e}")
 
 if __name__ == "__main__":
     run_imputation_engine()
@@ -0,0 +1,144 @@
+import argparse
+import functools
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+from instrumentation import StageLog
+from ingest import (INGEST_BATCH_ROWS, INGEST_WORKERS, PARSERS, create_hypertable, fetch_and_parse_metric,
+                    load_batch, mark_days_ingested, try_lock, unlock, update_aggregates,
+                    update_daily_adherence, worker_pools)
+from pipeline import bounded_map, batch_chunks, empty_chunk
+
+# Loads a range of synthetic days for a set of users in one go, e.g. for a newly enrolled participant:
+#   python backfill.py --users 4,5 --days 1-30
+# The work is split into (day, user) chunks that are fetched, parsed and loaded in parallel.
+# Every loaded chunk is checkpointed in backfill_chunks and skipped by the next backfill, so
+# an interrupted one resumes where it stopped. Rollups, adherence and cache invalidation run
+# once per day, as soon as all of that day's chunks are loaded, and only over that day.
+
+
+def parse_days(text):
+    """'1-30' or '7' as a range of synthetic day numbers."""
+    first, _, last = text.partition("-")
+    return range(int(first), int(last or first) + 1)
+
+
+def fetch_and_parse_chunk(chunk):
+    """Fetches and parses every metric of one (day, user_id) chunk; runs in a worker process."""
+    day, user_id = chunk
+    parsed = empty_chunk()
+    day_str = None
+    stages = StageLog()
+    for metric_name in PARSERS:
+        metric = fetch_and_parse_metric((user_id, metric_name, day))
+        for key in parsed:
+            parsed[key].extend(metric[key])
+        stages.entries.extend(metric["stages"].entries)
+        day_str = day_str or metric["day_str"]
+    parsed["stages"] = stages
+    return chunk, day_str, parsed
+
+
+def load_chunk(connections, parsed_chunk):
+    """Loads a parsed chunk batch by batch, then checkpoints it; returns the chunk and the rows inserted."""
+    (day, user_id), day_str, parsed = parsed_chunk
+    parsed["stages"].record()
+    inserted = sum(load_batch(connections, batch) for batch in batch_chunks([parsed], INGEST_BATCH_ROWS))
+    conn = connections.get()
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO backfill_chunks (day, user_id, date) VALUES (%s, %s, %s)
+            ON CONFLICT (day, user_id) DO UPDATE
+            SET date = EXCLUDED.date, loaded_at = clock_timestamp(), finalized = FALSE;
+        """, (day, user_id, day_str))
+    conn.commit()
+    return (day, user_id), inserted
+
+
+def finalize_day(conn, day, user_ids):
+    """Refreshes the rollups, adherence and ingested_days for a day whose chunks are all loaded.
+
+    Only the users' dirty ranges overlapping the day are refreshed; those of days still
+    being loaded stay queued until their own day is finalized.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT MIN(date) FROM backfill_chunks WHERE day = %s AND user_id = ANY(%s);", (day, user_ids))
+        date = cur.fetchone()[0]
+    conn.commit()
+    if date is not None:
+        start = datetime(date.year, date.month, date.day, tzinfo=timezone.utc)
+        update_aggregates(conn, user_ids, start, start + timedelta(days=1))
+        day_str = date.isoformat()
+        update_daily_adherence(conn, day_str, user_ids, {date})
+        mark_days_ingested(conn, day_str, user_ids)
+    with conn.cursor() as cur:
+        cur.execute("UPDATE backfill_chunks SET finalized = TRUE WHERE day = %s AND user_id = ANY(%s);", (day, user_ids))
+    conn.commit()
+    print(f"-> Day {day} ({date}) finalized for users {user_ids}.")
+
+
+def backfill(conn, pools, user_ids, days):
+    """Loads and finalizes every (day, user) chunk not already checkpointed; returns the rows inserted."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT day, user_id, finalized FROM backfill_chunks
+            WHERE day = ANY(%s) AND user_id = ANY(%s);
+        """, (list(days), user_ids))
+        done = {(day, user_id): finalized for day, user_id, finalized in cur.fetchall()}
+    conn.commit()
+
+    # Days are handed out in order, so the earliest ones finish and are finalized first
+    pending = [(day, user_id) for day in days for user_id in user_ids if (day, user_id) not in done]
+    remaining = {day: sum(1 for chunk in pending if chunk[0] == day) for day in days}
+    print(f"Backfilling {len(pending)} chunk(s); {len(done)} already loaded.")
+
+    # Days loaded by an interrupted backfill that stopped before finalizing them
+    for day in days:
+        if remaining[day] == 0 and not all(done.get((day, user_id)) for user_id in user_ids):
+            finalize_day(conn, day, user_ids)
+
+    connections, parse_pool, load_pool = pools
+    items_processed = 0
+    parsed_chunks = bounded_map(parse_pool, fetch_and_parse_chunk, pending, 2 * INGEST_WORKERS)
+    for (day, user_id), inserted in bounded_map(load_pool, functools.partial(load_chunk, connections),
+                                                parsed_chunks, INGEST_WORKERS):
+        items_processed += inserted
+        print(f"-> Chunk day {day}, user_id {user_id} loaded: {inserted} new rows.")
+        remaining[day] -= 1
+        if remaining[day] == 0:
+            finalize_day(conn, day, user_ids)
+    # Ranges that overlap none of the days, e.g. a sleep that ended before its date began
+    update_aggregates(conn)
+    return items_processed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill synthetic days for a set of users in parallel.")
+    parser.add_argument("--users", required=True, help="comma-separated user ids, e.g. 1,2,3")
+    parser.add_argument("--days", default="1-30", help="synthetic day or day range, e.g. 1-30")
+    args = parser.parse_args()
+    user_ids = [int(user_id) for user_id in args.users.split(",")]
+    days = parse_days(args.days)
+
+    db_url = os.getenv("DATABASE_URL")
+    connection = psycopg2.connect(db_url)
+    try:
+        # Scheduled ingestion runs are skipped while the backfill holds the lock
+        while not try_lock(connection):
+            print("Waiting for the running ingestion to finish...")
+            time.sleep(5)
+        try:
+            create_hypertable(connection)
+            start_time = time.time()
+            with worker_pools(db_url) as pools:
+                items_processed = backfill(connection, pools, user_ids, days)
+            print(f"Backfill complete: {items_processed} new rows in {time.time() - start_time:.1f}s.")
+        finally:
+            if not connection.closed:
+                connection.rollback()
+                unlock(connection)
+    finally:
+        connection.close()
@@ -0,0 +1,132 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Columnar counterparts of the per-point parsers in ingest.py. Instead of one
+# (time, user_id, metric_name, value) tuple per point they return one SeriesBatch
+# per metric with datetime64 times and float64 values, built a day at a time.
+# The tuple parsers stay in ingest.py as the reference implementation.
+SeriesBatch = namedtuple("SeriesBatch", ["user_id", "metric_name", "times", "values"])
+
+# ord(':') - ord('0'), what a colon looks like after subtracting the digit offset
+COLON = ord(":") - ord("0")
+
+
+def clock_seconds(clocks):
+    """Seconds since midnight for a list of 'HH:MM:SS' strings, or None if they are not all in that form."""
+    chars = np.array(clocks)
+    if chars.dtype != np.dtype("<U8") or np.char.str_len(chars).min() != 8:
+        return None
+    digits = chars.view(np.uint32).reshape(-1, 8).astype(np.int64) - ord("0")
+    if not ((digits[:, [2, 5]] == COLON).all() and ((digits[:, [0, 1, 3, 4, 6, 7]] >= 0) & (digits[:, [0, 1, 3, 4, 6, 7]] <= 9)).all()):
+        return None
+    hours = digits[:, 0] * 10 + digits[:, 1]
+    minutes = digits[:, 3] * 10 + digits[:, 4]
+    seconds = digits[:, 6] * 10 + digits[:, 7]
+    if hours.max() > 23 or minutes.max() > 59 or seconds.max() > 59:
+        return None
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def day_times(date_str, clocks):
+    """Timestamps for the clock times of one day and a mask of the ones that parsed, as parse_timestamps returns them."""
+    seconds = clock_seconds(clocks)
+    if seconds is None:
+        # Irregular clock strings ('08:30', fractional seconds) go through the full ISO parser
+        return parse_timestamps([f"{date_str}T{clock}" for clock in clocks])
+    return np.datetime64(date_str, "s") + seconds.astype("timedelta64[s]"), np.ones(len(clocks), dtype=bool)
+
+
+def parse_timestamps(strings):
+    """Parses full ISO timestamps in bulk; returns the times and a mask of the ones that parsed."""
+    try:
+        # Microsecond precision keeps fractional seconds, as fromisoformat does
+        return np.array(strings, dtype="datetime64[us]"), np.ones(len(strings), dtype=bool)
+    except ValueError:
+        times = np.empty(len(strings), dtype="datetime64[us]")
+        valid = np.ones(len(strings), dtype=bool)
+        for i, text in enumerate(strings):
+            try:
+                times[i] = np.datetime64(text, "us")
+            except ValueError as e:
+                print(f"Error parsing datetime for minute {text}: {e}")
+                valid[i] = False
+        return times, valid
+
+
+def optional_values(values):
+    """float64 values and the mask of entries that were not None."""
+    values = np.array(values, dtype=object)
+    present = values != None  # noqa: E711 - elementwise comparison
+    return values[present].astype(np.float64), present
+
+
+def parse_heart_rate_columns(records, user_id):
+    """Columnar parse_heart_rate: one intraday_heart_rate batch per day."""
+    batches = []
+    for day_data in records:
+        heart_rate_day = day_data.get('heart_rate_day', [{}])[0]
+        date_str = heart_rate_day.get('activities-heart', [{}])[0].get('dateTime')
+        dataset = heart_rate_day.get('activities-heart-intraday', {}).get('dataset', [])
+        if not date_str or not dataset:
+            continue
+        times, valid = day_times(date_str, [point['time'] for point in dataset])
+        if not valid.all():
+            # parse_heart_rate fails the whole day on a bad time
+            raise ValueError(f"Invalid heart rate time on {date_str}")
+        values = np.array([point['value'] for point in dataset], dtype=np.float64)
+        batches.append(SeriesBatch(user_id, 'intraday_heart_rate', times, values))
+    return batches
+
+
+def parse_spo2_columns(records, user_id):
+    """Columnar parse_spo2: one intraday_spo2 batch per day."""
+    batches = []
+    for day_data in records:
+        minutes_data = day_data.get('minutes', [])
+        if not day_data.get('dateTime') or not minutes_data:
+            continue
+        times, valid = parse_timestamps([point['minute'] for point in minutes_data])
+        values = np.array([point['value'] for point in minutes_data], dtype=np.float64)
+        batches.append(SeriesBatch(user_id, 'intraday_spo2', times[valid], values[valid]))
+    return batches
+
+
+def parse_azm_columns(records, user_id):
+    """Columnar parse_azm: one batch per AZM type and day."""
+    fields = [('azm_fat_burn', 'fatBurnActiveZoneMinutes'), ('azm_cardio', 'cardioActiveZoneMinutes'),
+              ('azm_peak', 'peakActiveZoneMinutes'), ('azm_total', 'activeZoneMinutes')]
+    batches = []
+    for day_data in records:
+        for record in day_data.get('activities-active-zone-minutes-intraday', []):
+            date_str = record.get('dateTime')
+            points = [point for point in record.get('minutes', []) if point.get('minute') and point.get('value')]
+            if not date_str or not points:
+                continue
+            times, valid = day_times(date_str, [point['minute'] for point in points])
+            for metric_name, key in fields:
+                # A missing AZM type counts as 0 minutes, an explicit null is skipped
+                values, present = optional_values([point['value'].get(key, 0) for point in points])
+                keep = valid[present]
+                batches.append(SeriesBatch(user_id, metric_name, times[present][keep], values[keep]))
+    return batches
+
+
+def rows_to_batches(rows):
+    """Groups (time, user_id, metric_name, value) tuples into one batch per (user_id, metric_name)."""
+    series = {}
+    for time, user_id, metric_name, value in rows:
+        times, values = series.setdefault((user_id, metric_name), ([], []))
+        times.append(time)
+        values.append(value)
+    return [SeriesBatch(user_id, metric_name, np.array(times, dtype="datetime64[us]"), np.array(values, dtype=np.float64))
+            for (user_id, metric_name), (times, values) in series.items()]
+
+
+def batches_to_rows(batches):
+    """Expands batches into the (time, user_id, metric_name, value) tuples the reference parsers return."""
+    rows = []
+    for batch in batches:
+        times = batch.times.astype("datetime64[us]").astype(object)
+        rows.extend((time, batch.user_id, batch.metric_name, float(value)) for time, value in zip(times, batch.values))
+    return rows
@@ -0,0 +1,103 @@
+import os
+import random
+import time
+import traceback
+from concurrent.futures import BrokenExecutor
+
+import psycopg2
+from prometheus_client import start_http_server
+
+from ingest import create_hypertable, ingest_data, read_watermark, try_lock, unlock, worker_pools
+from instrumentation import (REGISTRY, INGESTION_ERRORS, INGESTION_JOBS_TOTAL, INGESTION_LAST_SUCCESS,
+                             INGESTION_LATENCY, INGESTION_NEXT_DAY, INGESTION_THROUGHPUT)
+
+# Long-running ingestion service. It keeps its database connections, worker processes (with
+# their wearipedia devices) and metrics alive between runs. Every run holds the ingestion
+# advisory lock, so it never overlaps with another instance, a manual ingest.py run or a
+# backfill; while one of those holds the lock, runs are skipped.
+
+# Seconds between the starts of two runs
+INGEST_INTERVAL_SECONDS = float(os.getenv("INGEST_INTERVAL_SECONDS", "120"))
+# After a failure the next attempt is delayed by a jittered, doubling backoff up to this many seconds
+INGEST_BACKOFF_BASE_SECONDS = float(os.getenv("INGEST_BACKOFF_BASE_SECONDS", "5"))
+INGEST_BACKOFF_MAX_SECONDS = float(os.getenv("INGEST_BACKOFF_MAX_SECONDS", "600"))
+INGEST_METRICS_PORT = int(os.getenv("INGEST_METRICS_PORT", "9200"))
+
+
+def backoff_delay(failures):
+    """Doubling delay after consecutive failures, jittered so restarted instances do not retry in step."""
+    delay = min(INGEST_BACKOFF_MAX_SECONDS, INGEST_BACKOFF_BASE_SECONDS * 2 ** (failures - 1))
+    return random.uniform(delay / 2, delay)
+
+
+def run_once(conn, pools, check_schema=False):
+    """One ingestion run under the advisory lock; False if another process holds it.
+
+    With check_schema the schema migration runs first, under the same lock.
+    """
+    if not try_lock(conn):
+        print("Another ingestion process holds the lock. Skipping this run.")
+        return False
+    INGESTION_JOBS_TOTAL.inc()
+    start_time = time.time()
+    try:
+        if check_schema:
+            create_hypertable(conn)
+        items_processed = ingest_data(conn, pools)
+        duration = time.time() - start_time
+        # Avoid division by zero if the job was instant
+        INGESTION_THROUGHPUT.set(items_processed / duration if duration > 0 else items_processed)
+        INGESTION_LAST_SUCCESS.set_to_current_time()
+        INGESTION_NEXT_DAY.set(read_watermark(conn))
+        return True
+    finally:
+        INGESTION_LATENCY.set(time.time() - start_time)
+        if not conn.closed:
+            conn.rollback()
+            unlock(conn)
+
+
+def serve(db_url):
+    failures = 0
+    while True:
+        # Each pass (re)connects and starts the worker pools; it only ends
+        # when the connection is lost or a worker process died and the pool is unusable
+        conn = None
+        try:
+            print("Attempting to connect to the database...")
+            conn = psycopg2.connect(db_url)
+            # The schema is only checked once per connection instead of on every run,
+            # by the first run that gets the lock
+            schema_checked = False
+            with worker_pools(db_url) as pools:
+                while True:
+                    started = time.time()
+                    try:
+                        if run_once(conn, pools, check_schema=not schema_checked):
+                            schema_checked = True
+                        failures = 0
+                        delay = max(0, INGEST_INTERVAL_SECONDS - (time.time() - started))
+                    except Exception as e:
+                        INGESTION_ERRORS.inc()
+                        print("An error occurred during ingestion:")
+                        traceback.print_exc()
+                        if conn.closed or isinstance(e, BrokenExecutor):
+                            raise
+                        failures += 1
+                        conn.rollback()
+                        delay = backoff_delay(failures)
+                    print(f"Next run in {delay:.0f} seconds.")
+                    time.sleep(delay)
+        except Exception as e:
+            if conn is not None and not conn.closed:
+                conn.close()
+            failures += 1
+            delay = backoff_delay(failures)
+            print(f"Restarting the ingestion service in {delay:.0f} seconds: {e}")
+            time.sleep(delay)
+
+
+if __name__ == "__main__":
+    start_http_server(INGEST_METRICS_PORT, registry=REGISTRY)
+    print(f"Serving ingestion metrics on :{INGEST_METRICS_PORT}/metrics")
+    serve(os.getenv("DATABASE_URL"))
@@ -0,0 +1,88 @@
+import numpy as np
+
+# Gap-filling strategies of impute.py's numpy engine. A series is first averaged into a dense
+# array of buckets at the metric's granularity (NaN where a bucket is empty), then a strategy
+# returns a value for every bucket. Like interpolate() in the SQL engine, only buckets between
+# the first and the last non-empty one are filled. New strategies take (means, slots) and are
+# registered in STRATEGIES.
+
+
+def fill_linear(means, slots):
+    """Linear interpolation between the non-empty buckets on either side."""
+    known = np.flatnonzero(~np.isnan(means))
+    return np.interp(np.arange(len(means)), known, means[known])
+
+
+def fill_locf(means, slots):
+    """Last observation carried forward."""
+    known = ~np.isnan(means)
+    last = np.maximum.accumulate(np.where(known, np.arange(len(means)), 0))
+    return means[last]
+
+
+def fill_seasonal(means, slots):
+    """Mean of the non-empty buckets at the same time of day (slot) over the whole array."""
+    known = ~np.isnan(means)
+    slot_count = slots.max() + 1
+    sums = np.bincount(slots[known], weights=means[known], minlength=slot_count)
+    counts = np.bincount(slots[known], minlength=slot_count)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        profile = sums / counts
+    return np.where(known, means, profile[slots])
+
+
+STRATEGIES = {"linear": fill_linear, "locf": fill_locf, "seasonal": fill_seasonal}
+
+
+def bucket_means(times, values, origin, step, count):
+    """Averages points into count buckets of width step starting at origin; empty buckets are NaN."""
+    index = ((times - origin) // step).astype(np.int64)
+    keep = (index >= 0) & (index < count)
+    sums = np.bincount(index[keep], weights=values[keep], minlength=count)
+    counts = np.bincount(index[keep], minlength=count)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def run_lengths(missing):
+    """Length of the run of True values each position belongs to, 0 where missing is False."""
+    edges = np.diff(np.concatenate(([0], missing.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    lengths = np.zeros(len(missing), dtype=np.int64)
+    lengths[missing] = np.repeat(ends - starts, ends - starts)
+    return lengths
+
+
+def fill_gaps(means, strategy, slots, max_gap=0):
+    """Fills the empty buckets of means with a strategy; returns (positions filled, filled array).
+
+    Runs of more than max_gap empty buckets are left empty (0 fills every run).
+    """
+    known = np.flatnonzero(~np.isnan(means))
+    if len(known) < 2:
+        return np.array([], dtype=np.int64), means
+    missing = np.isnan(means)
+    missing[:known[0]] = False
+    missing[known[-1]:] = False
+    filled = STRATEGIES[strategy](means, slots)
+    if max_gap:
+        missing &= run_lengths(missing) <= max_gap
+    return np.flatnonzero(missing & ~np.isnan(filled)), filled
+
+
+def impute_series(times, values, origin, start, finish, step, strategy, max_gap=0):
+    """Imputed (times, values) of a series for the empty buckets in [start, finish).
+
+    times and values are the ingested points from origin on (datetime64[us], UTC); origin may
+    lie before start so that the seasonal strategy sees more days than the window itself.
+    Buckets are aligned to whole multiples of step, as time_bucket aligns them.
+    """
+    origin = origin - (origin - np.datetime64(0, "us")) % step
+    count = max(0, int(-(-(finish - origin) // step)))
+    means = bucket_means(times, values, origin, step, count)
+    bucket_times = origin + np.arange(count) * step
+    # Time-of-day slot of every bucket, for the seasonal strategy
+    slots = ((bucket_times - bucket_times.astype("datetime64[D]")) // step).astype(np.int64)
+    positions, filled = fill_gaps(means, strategy, slots, max_gap)
+    positions = positions[bucket_times[positions] >= start]
+    return bucket_times[positions], filled[positions]
@@ -0,0 +1,98 @@
+from datetime import timedelta
+
+from impute import METRIC_CONFIG, granularity_seconds
+from instrumentation import STAGE_ROWS, stage
+from rollups import coalesce
+
+# Gap index: for every (user_id, metric_name) in fitbit_data, the runs of empty buckets at the
+# metric's METRIC_CONFIG granularity between two ingested (not imputed) points. A gap is
+# [gap_start, gap_end): gap_start is the first empty bucket and gap_end the next non-empty one.
+# It is maintained from the same dirty ranges as the rollups, so every refresh only rescans
+# what the last loads wrote.
+
+# Widened to the nearest ingested point on either side, so gaps running into the range are rebuilt whole
+BOUNDS_QUERY = """
+    SELECT d.user_id, d.metric_name, d.width,
+           COALESCE((SELECT MAX(f.time) FROM fitbit_data f
+                     WHERE f.user_id = d.user_id AND f.metric_id = m.metric_id
+                         AND f.is_imputed = FALSE AND f.time < d.start_time), d.start_time),
+           COALESCE((SELECT MIN(f.time) FROM fitbit_data f
+                     WHERE f.user_id = d.user_id AND f.metric_id = m.metric_id
+                         AND f.is_imputed = FALSE AND f.time >= d.end_time), d.end_time)
+    FROM unnest(%s::bigint[], %s::text[], %s::timestamptz[], %s::timestamptz[], %s::interval[])
+        AS d(user_id, metric_name, start_time, end_time, width)
+    JOIN metrics m ON m.metric_name = d.metric_name;
+"""
+DELETE_QUERY = """
+    DELETE FROM data_gaps g
+    USING unnest(%s::bigint[], %s::text[], %s::timestamptz[], %s::timestamptz[]) AS b(user_id, metric_name, lo, hi)
+    WHERE g.user_id = b.user_id AND g.metric_name = b.metric_name AND g.gap_start <= b.hi AND g.gap_end > b.lo;
+"""
+# Ranges are numbered so that lead() never pairs buckets of two separate ranges of one series
+GAPS_QUERY = """
+    WITH buckets AS (
+        SELECT DISTINCT b.range_id, b.user_id, b.metric_name, b.width, time_bucket(b.width, f.time) AS bucket
+        FROM unnest(%s::bigint[], %s::text[], %s::interval[], %s::timestamptz[], %s::timestamptz[])
+            WITH ORDINALITY AS b(user_id, metric_name, width, lo, hi, range_id)
+        JOIN metrics m ON m.metric_name = b.metric_name
+        JOIN fitbit_data f ON f.user_id = b.user_id AND f.metric_id = m.metric_id
+            AND f.is_imputed = FALSE AND f.time >= b.lo AND f.time <= b.hi
+    ), runs AS (
+        SELECT user_id, metric_name, width, bucket + width AS gap_start,
+               lead(bucket) OVER (PARTITION BY range_id ORDER BY bucket) AS gap_end
+        FROM buckets
+    )
+    INSERT INTO data_gaps (user_id, metric_name, gap_start, gap_end, buckets)
+    SELECT user_id, metric_name, gap_start, gap_end,
+           (EXTRACT(EPOCH FROM gap_end - gap_start) / EXTRACT(EPOCH FROM width))::bigint
+    FROM runs
+    WHERE gap_end > gap_start
+    ON CONFLICT (user_id, metric_name, gap_start) DO UPDATE
+    SET gap_end = EXCLUDED.gap_end, buckets = EXCLUDED.buckets;
+"""
+
+
+def merge_bounds(bounds):
+    """Merges (user_id, metric_name, width, lo, hi) ranges of one series that overlap once widened.
+
+    Two dirty ranges with no ingested point between them widen onto each other, and each
+    would otherwise rebuild the gap between them.
+    """
+    merged = []
+    for user_id, metric_name, width, lo, hi in sorted(bounds, key=lambda row: (row[0], row[1], row[3])):
+        if merged and merged[-1][:2] == [user_id, metric_name] and lo <= merged[-1][4]:
+            merged[-1][4] = max(merged[-1][4], hi)
+        else:
+            merged.append([user_id, metric_name, width, lo, hi])
+    return merged
+
+
+def refresh_gaps(cur, dirty):
+    """Rebuilds the gaps around dirty (user_id, metric_name, start, end) ranges; runs in the caller's transaction.
+
+    Metrics that are not in METRIC_CONFIG have no granularity and are not indexed.
+    Returns the number of gaps written.
+    """
+    ranges = []
+    by_metric = {}
+    for user_id, metric_name, start, end in dirty:
+        if metric_name in METRIC_CONFIG and METRIC_CONFIG[metric_name]['table'] == 'fitbit_data':
+            by_metric.setdefault(metric_name, []).append((user_id, metric_name, start, end))
+    for metric_name, series in by_metric.items():
+        width = timedelta(seconds=granularity_seconds(metric_name))
+        ranges.extend(row + [width] for row in coalesce(series, width))
+    if not ranges:
+        return 0
+
+    with stage("gaps", "data_gaps"):
+        cur.execute(BOUNDS_QUERY, [list(column) for column in zip(*ranges)])
+        bounds = merge_bounds(cur.fetchall())
+        if not bounds:
+            return 0
+        user_ids, metric_names, widths, lows, highs = (list(column) for column in zip(*bounds))
+        cur.execute(DELETE_QUERY, (user_ids, metric_names, lows, highs))
+        cur.execute(GAPS_QUERY, (user_ids, metric_names, widths, lows, highs))
+        written = max(cur.rowcount, 0)
+    STAGE_ROWS.labels(stage="gaps", metric="data_gaps").inc(written)
+    print(f"Rebuilt {written} gap(s) over {len(ranges)} dirty range(s).")
+    return written
@@ -2,11 +2,21 @@ import os
 import psycopg2
 import wearipedia
 import numpy as np
-from datetime import datetime, date
+from datetime import datetime
 from psycopg2.extras import execute_values
+from loader import REGISTER_METRICS, load_rows, load_series
+from columnar import parse_heart_rate_columns, parse_spo2_columns, parse_azm_columns, rows_to_batches
+from pipeline import ConnectionPerThread, bounded_map, batch_chunks, chunk_size, empty_chunk
+from rollups import drain_dirty, mark_dirty, refresh_rollups
+from gaps import refresh_gaps
+from instrumentation import (REGISTRY, STAGE_ERRORS, STAGE_ROWS, INGESTION_ERRORS, INGESTION_JOBS_TOTAL,
+                             INGESTION_LAST_SUCCESS, INGESTION_LATENCY, INGESTION_THROUGHPUT, StageLog, stage)
+import contextlib
+import functools
 import traceback
 import time
-from prometheus_client import CollectorRegistry, Gauge, Counter, push_to_gateway
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from prometheus_client import push_to_gateway
 
 
 # It seems wearipedia library's synthetic data is not date-range specific.
@@ -206,30 +216,120 @@ def parse_hrv(records, user_id):
     return parsed_data
 
 
+# Columns of every hypertable. The metric is stored as a SMALLINT id from the metrics dictionary
+# rather than its name, which used to be repeated on every row and in every unique index entry
+HYPERTABLE_COLUMNS = {
+    "fitbit_data": """
+        time TIMESTAMPTZ NOT NULL,
+        user_id BIGINT NOT NULL,
+        metric_id SMALLINT NOT NULL,
+        value DOUBLE PRECISION NOT NULL,
+        is_imputed BOOLEAN DEFAULT FALSE,
+        UNIQUE(time, user_id, metric_id)
+    """,
+}
+#Aggregate Tables (storing average values)
+# Count, sum, min and max are kept next to the average so coarser buckets can be
+# merged exactly from finer ones and min/max bands never need the raw data
+for interval in ['1m', '1h', '1d']:
+    HYPERTABLE_COLUMNS[f'data_{interval}'] = """
+        time TIMESTAMPTZ NOT NULL, user_id BIGINT NOT NULL,
+        metric_id SMALLINT NOT NULL, avg_value DOUBLE PRECISION NOT NULL,
+        sample_count BIGINT, sum_value DOUBLE PRECISION,
+        min_value DOUBLE PRECISION, max_value DOUBLE PRECISION,
+        UNIQUE(time, user_id, metric_id)
+    """
+
+
+def create_table(cur, table_name, target=None):
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {target or table_name} ({HYPERTABLE_COLUMNS[table_name]});")
+    cur.execute(f"SELECT create_hypertable('{target or table_name}', 'time', if_not_exists => TRUE);")
+
+
+def table_columns(cur, table_name):
+    """Column names of table_name, empty if it does not exist yet."""
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s;
+    """, (table_name,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def migrate_metric_ids(cur, table_name):
+    """Rewrites a hypertable that still stores metric_name into the metric_id layout, in the caller's transaction.
+
+    The rows are copied into a new hypertable rather than updated in place, which would leave
+    a dead copy of every row behind.
+    """
+    columns = table_columns(cur, table_name)
+    if "metric_name" not in columns:
+        return
+    print(f"Migrating {table_name} from metric names to metric ids...")
+    cur.execute(REGISTER_METRICS.format(source=table_name))
+    create_table(cur, table_name, f"{table_name}_by_id")
+    kept = [column for column in columns if column != "metric_name"]
+    cur.execute(f"""
+        INSERT INTO {table_name}_by_id ({", ".join(kept)}, metric_id)
+        SELECT {", ".join("t." + column for column in kept)}, m.metric_id
+        FROM {table_name} t JOIN metrics m ON m.metric_name = t.metric_name;
+    """)
+    cur.execute(f"DROP TABLE {table_name};")
+    cur.execute(f"ALTER TABLE {table_name}_by_id RENAME TO {table_name};")
+
+
+def add_rollup_stats(cur, table_name):
+    """Adds count/sum/min/max to a rollup created without them and fills them from the raw data."""
+    print(f"Backfilling count/sum/min/max in {table_name}...")
+    interval = table_name.removeprefix('data_')
+    cur.execute(f"""
+        ALTER TABLE {table_name}
+            ADD COLUMN IF NOT EXISTS sample_count BIGINT,
+            ADD COLUMN IF NOT EXISTS sum_value DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS min_value DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS max_value DOUBLE PRECISION;
+    """)
+    cur.execute(f"""
+        UPDATE {table_name} t
+        SET sample_count = s.sample_count, sum_value = s.sum_value,
+            min_value = s.min_value, max_value = s.max_value
+        FROM (
+            SELECT time_bucket('{interval}', time) AS time, user_id, metric_id,
+                   COUNT(value) AS sample_count, SUM(value) AS sum_value,
+                   MIN(value) AS min_value, MAX(value) AS max_value
+            FROM fitbit_data
+            WHERE is_imputed = FALSE
+            GROUP BY 1, 2, 3
+        ) s
+        WHERE t.time = s.time AND t.user_id = s.user_id AND t.metric_id = s.metric_id;
+    """)
+    # Buckets whose raw rows are gone keep their average as a single sample
+    cur.execute(f"""
+        UPDATE {table_name}
+        SET sample_count = 1, sum_value = avg_value, min_value = avg_value, max_value = avg_value
+        WHERE sample_count IS NULL;
+    """)
+
+
 def create_hypertable(conn):
     with conn.cursor() as cur:
+        # Dictionary of metric names; the hypertables only store the small integer id
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS fitbit_data (
-                time TIMESTAMPTZ NOT NULL,
-                user_id BIGINT NOT NULL,
-                metric_name TEXT NOT NULL,
-                value DOUBLE PRECISION NOT NULL,
-                is_imputed BOOLEAN DEFAULT FALSE,
-                UNIQUE(time, user_id, metric_name)
+            CREATE TABLE IF NOT EXISTS metrics (
+                metric_id SMALLSERIAL PRIMARY KEY,
+                metric_name TEXT NOT NULL UNIQUE
             );
         """)
-        cur.execute("SELECT create_hypertable('fitbit_data', 'time', if_not_exists => TRUE);")
-
-        #Aggregate Tables (storing average values)
-        for interval in ['1m', '1h', '1d']:
-            table_name = f'data_{interval}'
-            cur.execute(f"""
-                CREATE TABLE IF NOT EXISTS {table_name} (
-                    time TIMESTAMPTZ NOT NULL, user_id BIGINT NOT NULL,
-                    metric_name TEXT NOT NULL, avg_value DOUBLE PRECISION NOT NULL,
-                    UNIQUE(time, user_id, metric_name));
-            """)
-            cur.execute(f"SELECT create_hypertable('{table_name}', 'time', if_not_exists => TRUE);")
+        # Rollups created before count/sum/min/max were kept get them once; checked before
+        # migrate_metric_ids, which recreates the table with the new columns left empty
+        stats_missing = []
+        for table_name in HYPERTABLE_COLUMNS:
+            columns = table_columns(cur, table_name)
+            if table_name != 'fitbit_data' and columns and "sample_count" not in columns:
+                stats_missing.append(table_name)
+            migrate_metric_ids(cur, table_name)
+            create_table(cur, table_name)
+        for table_name in stats_missing:
+            add_rollup_stats(cur, table_name)
 
         cur.execute("""
             CREATE TABLE IF NOT EXISTS daily_zones (
@@ -253,169 +353,400 @@ def create_hypertable(conn):
             );
         """)
 
+        # One row per (day, user) written by ingestion; the backend polls it to invalidate cached responses
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ingested_days (
+                date DATE NOT NULL,
+                user_id BIGINT NOT NULL,
+                ingested_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+                PRIMARY KEY(date, user_id)
+            );
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS ingested_days_ingested_at_idx ON ingested_days (ingested_at);")
+
+        # Next synthetic day to ingest, advanced in the same transaction that records a finished day
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ingestion_state (
+                id INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                next_day INT NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+            );
+        """)
+
+        # (day, user) chunks finished by backfill.py, so an interrupted backfill resumes where it stopped
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_chunks (
+                day INT NOT NULL,
+                user_id BIGINT NOT NULL,
+                date DATE,
+                loaded_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+                finalized BOOLEAN NOT NULL DEFAULT FALSE,
+                PRIMARY KEY(day, user_id)
+            );
+        """)
+
+        # Newest ingested point impute.py has gap-filled up to per series, so each run only imputes newer data
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS imputation_state (
+                user_id BIGINT NOT NULL,
+                metric_name TEXT NOT NULL,
+                imputed_until TIMESTAMPTZ NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+                PRIMARY KEY(user_id, metric_name)
+            );
+        """)
+
+        # Runs of empty buckets per series at the metric's granularity, maintained with the rollups (see gaps.py)
+        cur.execute("SELECT to_regclass('data_gaps') IS NULL;")
+        index_gaps = cur.fetchone()[0]
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS data_gaps (
+                user_id BIGINT NOT NULL,
+                metric_name TEXT NOT NULL,
+                gap_start TIMESTAMPTZ NOT NULL,
+                gap_end TIMESTAMPTZ NOT NULL,
+                buckets BIGINT NOT NULL,
+                PRIMARY KEY(user_id, metric_name, gap_start)
+            );
+        """)
+        if index_gaps:
+            # First run against an existing database: index every series over everything already loaded
+            cur.execute("""
+                SELECT f.user_id, m.metric_name, MIN(f.time), MAX(f.time)
+                FROM fitbit_data f JOIN metrics m ON m.metric_id = f.metric_id
+                WHERE f.is_imputed = FALSE GROUP BY 1, 2;
+            """)
+            refresh_gaps(cur, cur.fetchall())
+
+        # Ranges of fitbit_data written since the rollups were last refreshed, queued with every load batch
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS rollup_dirty (
+                user_id BIGINT NOT NULL,
+                metric_name TEXT NOT NULL,
+                start_time TIMESTAMPTZ NOT NULL,
+                end_time TIMESTAMPTZ NOT NULL
+            );
+        """)
+
+        # Per-user, per-day adherence inputs so /adherence never has to scan fitbit_data
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS daily_adherence (
+                date DATE NOT NULL,
+                user_id BIGINT NOT NULL,
+                wear_minutes INT NOT NULL DEFAULT 0,
+                sleep_minutes INT,
+                PRIMARY KEY(date, user_id)
+            );
+        """)
+        cur.execute("SELECT EXISTS (SELECT 1 FROM daily_adherence);")
+        if not cur.fetchone()[0]:
+            # First run against an existing database: build the summary from what is already loaded
+            cur.execute("""
+                INSERT INTO daily_adherence (date, user_id, wear_minutes)
+                SELECT time::date, user_id, COUNT(DISTINCT date_trunc('minute', time))
+                FROM fitbit_data
+                WHERE metric_id = (SELECT metric_id FROM metrics WHERE metric_name = 'intraday_heart_rate')
+                GROUP BY 1, 2;
+            """)
+            cur.execute("""
+                INSERT INTO daily_adherence (date, user_id, sleep_minutes)
+                SELECT date, user_id, minutes_asleep FROM sleep_summary
+                ON CONFLICT (date, user_id) DO UPDATE SET sleep_minutes = EXCLUDED.sleep_minutes;
+            """)
+
     conn.commit()
     print("All tables and hypertables are ready.")
 
 
-def update_aggregates(conn, day_to_process_str):
-    """Calculate and insert/update aggregates for a specific day."""
-    print(f"Updating aggregates for date: {day_to_process_str}...")
-    total_rows_affected = 0
+def update_aggregates(conn, user_ids=None, start=None, end=None):
+    """Refreshes the rollup buckets and the gap index touched since the last refresh (see rollups.py, gaps.py).
+
+    With user_ids, only their dirty ranges overlapping [start, end) are refreshed and the rest stay queued.
+    """
+    print("Updating aggregates for the dirty ranges...")
     try:
         with conn.cursor() as cur:
-            for interval in ['1m', '1h', '1d']:
-                table_name = f"data_{interval}" # e.g., data_1m
-                cur.execute(f"""
-                    INSERT INTO {table_name} (time, user_id, metric_name, avg_value)
-                    SELECT
-                        time_bucket('{interval}', time),
-                        user_id,
-                        metric_name,
-                        AVG(value)
-                    FROM fitbit_data
-                    WHERE time >= %s::date AND time < (%s::date + '1 day'::interval) AND is_imputed = FALSE
-                    GROUP BY 1, 2, 3
-                    ON CONFLICT (time, user_id, metric_name) DO UPDATE
-                    SET avg_value = EXCLUDED.avg_value;
-                """, (day_to_process_str, day_to_process_str))
-                rows_for_interval = cur.rowcount
-                print(f"Inserted/Updated {rows_for_interval} aggregates for interval '{interval}'.")
-                total_rows_affected += rows_for_interval
-            print(f"Inserted {cur.rowcount} aggregates for day {day_to_process_str}.")
+            dirty = drain_dirty(cur, user_ids, start, end)
+            rows = refresh_rollups(cur, dirty)
+            refresh_gaps(cur, dirty)
         conn.commit()
         print("Aggregates updated successfully.")
-        return total_rows_affected
+        return sum(rows.values())
     except Exception as e:
         print(f"An error occurred: {e}")
-        conn.rollback()  # Roll back the transaction on error
-        return 0 # Return 0 or raise the exception
-            
+        conn.rollback()  # The dirty ranges stay queued for the next run
+        return 0
 
 
-def ingest_data(conn):
-    # with open("/app/synthetic_fitbit_data.json", "r") as f:
-    #     data = json.load(f)
+def update_daily_adherence(conn, day_str, user_ids, sleep_dates):
+    """Refreshes the wear minutes of one day and the sleep minutes of the given sleep dates."""
+    with conn.cursor() as cur:
+        # Wear time is the number of distinct minutes with any heart rate sample, as /adherence used to count it
+        cur.execute("""
+            INSERT INTO daily_adherence (date, user_id, wear_minutes)
+            SELECT %s::date, u.user_id, COUNT(DISTINCT date_trunc('minute', fd.time))
+            FROM unnest(%s::bigint[]) AS u(user_id)
+            LEFT JOIN fitbit_data fd ON fd.user_id = u.user_id
+                AND fd.metric_id = (SELECT metric_id FROM metrics WHERE metric_name = 'intraday_heart_rate')
+                AND fd.time >= %s::date AND fd.time < (%s::date + '1 day'::interval)
+            GROUP BY u.user_id
+            ON CONFLICT (date, user_id) DO UPDATE SET wear_minutes = EXCLUDED.wear_minutes;
+        """, (day_str, list(user_ids), day_str, day_str))
+        if sleep_dates:
+            cur.execute("""
+                INSERT INTO daily_adherence (date, user_id, sleep_minutes)
+                SELECT date, user_id, minutes_asleep FROM sleep_summary
+                WHERE user_id = ANY(%s) AND date = ANY(%s::date[])
+                ON CONFLICT (date, user_id) DO UPDATE SET sleep_minutes = EXCLUDED.sleep_minutes;
+            """, (list(user_ids), sorted(sleep_dates)))
+    conn.commit()
 
-    # --- State Management ---
-    day_file = "/app/state/day_counter.txt"
-    os.makedirs(os.path.dirname(day_file), exist_ok=True)
 
-    try:
-        with open(day_file, "r") as f:
-            # Day is 1-indexed (1-30)
-            day_to_process = int(f.read().strip())
-    except FileNotFoundError:
-        day_to_process = 1
-
-    print(f"--- Cron job running. Attempting to process day: {day_to_process} ---")
-
-
-    # device = wearipedia.get_device("fitbit/fitbit_charge_6")
-    # device1 = wearipedia.get_device("fitbit/fitbit_sense")
-
-    # Map metric names to their parser functions
-    parsers = {
-        "intraday_heart_rate": [parse_heart_rate, parse_zones],
-        # "intraday_heart_rate": parse_zones,
-        "intraday_spo2": [parse_spo2],
-        "intraday_breath_rate": [parse_breathing_rate],
-        "intraday_active_zone_minute": [parse_azm],
-        "intraday_activity": [parse_activity],
-        "intraday_hrv": [parse_hrv],
-        "sleep": [parse_sleep]
-    }
-    items_processed = 0
-    all_parsed_data = [] 
-    all_sleep_data = []
-    all_zone_data = []
-
-    user_ids_ingest = [1,2,3]
-    for user_id in user_ids_ingest:
-        print(f"--- Processing data for user_id: {user_id} ---")
-        device = wearipedia.get_device("fitbit/fitbit_charge_6")
-        device1 = wearipedia.get_device("fitbit/fitbit_sense")
-        for metric_name in parsers:
-            # if metric_name in parsers:
-            print(f"Fetching and parsing {metric_name} for user_id: {user_id}...")
-            for parser_func in parsers[metric_name]:
-                # parser_func = parsers[metric_name]
-                if metric_name == "sleep":
-                    records = device1.get_data(metric_name)
-                else:
-                    records = device.get_data(metric_name)
-                if not records or len(records) < day_to_process:
-                    print(f"Warning: Data for day {day_to_process} for user_id: {user_id} not available for {metric_name}. Skipping.")
-                    continue
-                if records is None:
-                    print(f"Warning: No data returned for day {day_to_process} for {metric_name} for user_id: {user_id}. Skipping.")
-                    continue
-                # Select only the data for the specific day we need to process
-                # The list is 0-indexed, so we subtract 1
-                day_specific_data = [records[day_to_process - 1]]
-                try:
-                    if parser_func == parse_zones:
-                        zone_data = parser_func(day_specific_data, user_id)
-                        all_zone_data.extend(zone_data)
-                        print(f"Parsed {len(zone_data)} points for {metric_name} zone_data for day {day_to_process} for user_id: {user_id}.")
-                    elif parser_func == parse_sleep:
-                        sleep_data = parser_func(records, user_id)
-                        all_sleep_data.extend(sleep_data)
-                        print(f"Parsed {len(sleep_data)} points for {metric_name} for day {day_to_process} for user_id: {user_id}.")
-                    else:
-                        parsed_data = parser_func(day_specific_data, user_id)
-                        all_parsed_data.extend(parsed_data)
-                        day_str = parsed_data[0][0].strftime('%Y-%m-%d') if parsed_data else date.today().strftime('%Y-%m-%d')
-                        print(f"Parsed {len(parsed_data)} points for {metric_name} for day {day_to_process} for user_id: {user_id}.")
-                except Exception as e:
-                    print(f"-> Error parsing {metric_name} for user_id: {user_id} for day {day_to_process}: {e}")
-
-
-    if not all_parsed_data:
-        print("No new data to insert.")
-        return 0
+def mark_days_ingested(conn, day_str, user_ids, next_day=None):
+    """Records the (day, user) pairs just written so cached backend responses covering them are dropped.
 
+    If next_day is given the watermark moves to it in the same transaction, so a run that
+    fails before this point is simply repeated.
+    """
     with conn.cursor() as cur:
-        # Use execute_values for efficient bulk insertion
         execute_values(
             cur,
-            "INSERT INTO fitbit_data (time, user_id, metric_name, value) VALUES %s ON CONFLICT DO NOTHING;",
-            all_parsed_data
+            """INSERT INTO ingested_days (date, user_id) VALUES %s
+               ON CONFLICT (date, user_id) DO UPDATE SET ingested_at = clock_timestamp();""",
+            [(day_str, user_id) for user_id in user_ids]
         )
-        print(f"-> Inserted {cur.rowcount} new rows for day {day_to_process}.")
-        items_processed += cur.rowcount
+        if next_day is not None:
+            cur.execute("UPDATE ingestion_state SET next_day = %s, updated_at = clock_timestamp() WHERE id = 1;", (next_day,))
     conn.commit()
 
-    if all_zone_data:
-        with conn.cursor() as cur:
-            execute_values(
-                cur,
-                "INSERT INTO daily_zones (date, user_id, zone_name, min_hr, max_hr) VALUES %s ON CONFLICT DO NOTHING;",
-                all_zone_data
-            )
-            print(f"Inserted {cur.rowcount} new zone definitions for day {day_to_process}.")
-            items_processed += cur.rowcount
-        conn.commit()
 
-    if all_sleep_data:
+def read_watermark(conn):
+    """Returns the next day to ingest, seeding ingestion_state from the old cron state file on first use."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT next_day FROM ingestion_state WHERE id = 1;")
+        row = cur.fetchone()
+        if row is None:
+            try:
+                with open(DAY_FILE, "r") as f:
+                    # Day is 1-indexed (1-30)
+                    day = int(f.read().strip())
+            except FileNotFoundError:
+                day = 1
+            cur.execute("INSERT INTO ingestion_state (id, next_day) VALUES (1, %s) ON CONFLICT (id) DO NOTHING;", (day,))
+            cur.execute("SELECT next_day FROM ingestion_state WHERE id = 1;")
+            row = cur.fetchone()
+    conn.commit()
+    return row[0]
+
+
+def try_lock(conn):
+    """Takes the ingestion advisory lock for this connection's session; False if another process holds it.
+
+    The lock is released by unlock or when the session ends, so a crashed run never leaves it behind.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (INGEST_LOCK_ID,))
+        locked = cur.fetchone()[0]
+    conn.commit()
+    return locked
+
+
+def unlock(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_unlock(%s);", (INGEST_LOCK_ID,))
+    conn.commit()
+
+
+# Map metric names to their parser functions
+# The dense intraday metrics use the columnar parsers from columnar.py; parse_heart_rate,
+# parse_spo2 and parse_azm above are kept as their reference implementation. HRV has
+# 96 points a day and parses no faster in columns, so it stays on parse_hrv
+PARSERS = {
+    "intraday_heart_rate": [parse_heart_rate_columns, parse_zones],
+    # "intraday_heart_rate": parse_zones,
+    "intraday_spo2": [parse_spo2_columns],
+    "intraday_breath_rate": [parse_breathing_rate],
+    "intraday_active_zone_minute": [parse_azm_columns],
+    "intraday_activity": [parse_activity],
+    "intraday_hrv": [parse_hrv],
+    "sleep": [parse_sleep]
+}
+COLUMNAR_PARSERS = {parse_heart_rate_columns, parse_spo2_columns, parse_azm_columns}
+
+# Number of (user, metric) pairs fetched and parsed in parallel, and of concurrent database loads
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+# Upper bound on the rows written and committed by one load
+INGEST_BATCH_ROWS = int(os.getenv("INGEST_BATCH_ROWS", "50000"))
+# Progress file of the former cron job; only read to seed ingestion_state
+DAY_FILE = "/app/state/day_counter.txt"
+# Session advisory lock held by whichever process is ingesting, so runs never overlap
+INGEST_LOCK_ID = 72160001
+
+
+@functools.lru_cache(maxsize=None)
+def get_device(name):
+    # wearipedia generates a device's synthetic data on its first get_data call; keeping the
+    # device for the life of the worker process generates it once instead of once per task
+    return wearipedia.get_device(name)
+
+
+def fetch_and_parse_metric(task):
+    """Fetches one metric of one user for a day and runs its parsers; runs in a worker process.
+
+    task is a (user_id, metric_name, day_to_process) tuple. Returns the rows for fitbit_data,
+    daily_zones and sleep_summary, the SeriesBatches of the columnar parsers (also for
+    fitbit_data), the day the rows belong to and the StageLog of the fetch and parse timings.
+    """
+    user_id, metric_name, day_to_process = task
+    parsed = empty_chunk()
+    parsed["day_str"] = None
+    parsed["stages"] = stages = StageLog()
+    print(f"Fetching and parsing {metric_name} for user_id: {user_id}...")
+    with stages.stage("fetch", metric_name):
+        if metric_name == "sleep":
+            records = get_device("fitbit/fitbit_sense").get_data(metric_name)
+        else:
+            records = get_device("fitbit/fitbit_charge_6").get_data(metric_name)
+    if not records or len(records) < day_to_process:
+        print(f"Warning: Data for day {day_to_process} for user_id: {user_id} not available for {metric_name}. Skipping.")
+        return parsed
+    # Select only the data for the specific day we need to process
+    # The list is 0-indexed, so we subtract 1
+    day_specific_data = [records[day_to_process - 1]]
+    for parser_func in PARSERS[metric_name]:
+        try:
+            with stages.stage("parse", metric_name):
+                if parser_func == parse_zones:
+                    zone_data = parser_func(day_specific_data, user_id)
+                    parsed["daily_zones"].extend(zone_data)
+                    print(f"Parsed {len(zone_data)} points for {metric_name} zone_data for day {day_to_process} for user_id: {user_id}.")
+                elif parser_func in COLUMNAR_PARSERS:
+                    batches = parser_func(day_specific_data, user_id)
+                    parsed["series"].extend(batches)
+                    first = next((batch for batch in batches if len(batch.times)), None)
+                    if first is not None and parsed["day_str"] is None:
+                        parsed["day_str"] = str(first.times[0].astype("datetime64[D]"))
+                    print(f"Parsed {sum(len(batch.times) for batch in batches)} points for {metric_name} for day {day_to_process} for user_id: {user_id}.")
+                elif parser_func == parse_sleep:
+                    sleep_data = parser_func(records, user_id)
+                    parsed["sleep_summary"].extend(sleep_data)
+                    print(f"Parsed {len(sleep_data)} points for {metric_name} for day {day_to_process} for user_id: {user_id}.")
+                else:
+                    parsed_data = parser_func(day_specific_data, user_id)
+                    parsed["fitbit_data"].extend(parsed_data)
+                    if parsed_data and parsed["day_str"] is None:
+                        parsed["day_str"] = parsed_data[0][0].strftime('%Y-%m-%d')
+                    print(f"Parsed {len(parsed_data)} points for {metric_name} for day {day_to_process} for user_id: {user_id}.")
+        except Exception as e:
+            print(f"-> Error parsing {metric_name} for user_id: {user_id} for day {day_to_process}: {e}")
+    stages.rows("parse", metric_name, chunk_size(parsed))
+    return parsed
+
+
+@contextlib.contextmanager
+def worker_pools(db_url):
+    """Loader connections, parse processes and load threads; kept warm across runs by the daemon."""
+    # The connections are closed only after the load pool has finished with them
+    with ConnectionPerThread(db_url) as connections, \
+            ProcessPoolExecutor(max_workers=INGEST_WORKERS) as parse_pool, \
+            ThreadPoolExecutor(max_workers=INGEST_WORKERS) as load_pool:
+        yield connections, parse_pool, load_pool
+
+
+# fitbit_data is loaded with load_series, which also swaps metric names for ids
+LOAD_COLUMNS = {
+    "fitbit_data": None,
+    "daily_zones": ["date", "user_id", "zone_name", "min_hr", "max_hr"],
+    "sleep_summary": ["date", "user_id", "minutes_asleep", "efficiency"],
+}
+
+
+def load_batch(connections, batch):
+    """Loads one batch over the calling thread's connection and commits it; returns the rows inserted."""
+    conn = connections.get()
+    inserted = 0
+    try:
+        for table, columns in LOAD_COLUMNS.items():
+            series = batch["series"] if table == "fitbit_data" else []
+            if not batch[table] and not series:
+                continue
+            with stage("load", table):
+                # Bulk load through COPY and a staging table; rows that already exist are skipped
+                if table == "fitbit_data":
+                    table_inserted = load_series(conn, series + rows_to_batches(batch[table]))
+                else:
+                    table_inserted = load_rows(conn, table, columns, batch[table])
+            STAGE_ROWS.labels(stage="load", metric=table).inc(table_inserted)
+            inserted += table_inserted
         with conn.cursor() as cur:
-            execute_values(
-                cur,
-                "INSERT INTO sleep_summary (date, user_id, minutes_asleep, efficiency) VALUES %s ON CONFLICT DO NOTHING;",
-                all_sleep_data
-            )
-            print(f"Bulk insert complete for sleep_summary. Processed {cur.rowcount} new rows for day {day_to_process}.")
-            items_processed += cur.rowcount
+            mark_dirty(cur, batch)
         conn.commit()
+    except Exception:
+        # Leave the thread's connection usable for the next batch
+        if not conn.closed:
+            conn.rollback()
+        raise
+    print(f"-> Loaded a batch of {chunk_size(batch)} rows, {inserted} new.")
+    return inserted
 
-    items_processed+=update_aggregates(conn, day_str)
+
+def ingest_data(conn, pools):
+    """Ingests the day at the watermark with the (connections, parse_pool, load_pool) from worker_pools.
+
+    The caller must hold the ingestion lock (see try_lock).
+    """
+    # with open("/app/synthetic_fitbit_data.json", "r") as f:
+    #     data = json.load(f)
+
+    # --- State Management ---
+    day_to_process = read_watermark(conn)
+    print(f"--- Ingestion run starting. Attempting to process day: {day_to_process} ---")
+
+    items_processed = 0
+    all_sleep_dates = set()
+    day_str = None
+
+    user_ids_ingest = [1,2,3]
+    tasks = ((user_id, metric_name, day_to_process) for user_id in user_ids_ingest for metric_name in PARSERS)
+
+    def track(parsed_chunks):
+        # Notes the day and sleep dates of each chunk on its way to the batcher
+        nonlocal day_str
+        try:
+            for parsed in parsed_chunks:
+                # Fetch and parse ran in a worker process; their timings come back with the chunk
+                parsed["stages"].record()
+                day_str = day_str or parsed["day_str"]
+                all_sleep_dates.update(row[0].date() for row in parsed["sleep_summary"])
+                yield parsed
+        except Exception as e:
+            # Parser errors are handled in the workers, so a task only fails if its fetch did
+            STAGE_ERRORS.labels(stage="fetch", error=type(e).__name__).inc()
+            raise
+
+    # fetch/parse -> batch -> load, each stage pulling from the previous one only when it has
+    # room: at most 2 * INGEST_WORKERS parsed chunks and INGEST_WORKERS batches are held at a
+    # time however many users there are, and every batch is committed as soon as it is loaded
+    connections, parse_pool, load_pool = pools
+    parsed_chunks = bounded_map(parse_pool, fetch_and_parse_metric, tasks, 2 * INGEST_WORKERS)
+    batches = batch_chunks(track(parsed_chunks), INGEST_BATCH_ROWS)
+    for inserted in bounded_map(load_pool, functools.partial(load_batch, connections), batches, INGEST_WORKERS):
+        items_processed += inserted
+
+    # day_str is only set once some user had time series rows
+    if day_str is None:
+        print("No new data to insert.")
+        return 0
+
+    items_processed+=update_aggregates(conn)
+    update_daily_adherence(conn, day_str, user_ids_ingest, all_sleep_dates)
 
     # --- Update State for Next Run ---
     next_day = day_to_process + 1
     if next_day > 30: # Reset after day 30
         next_day = 1
-    
-    with open(day_file, "w") as f:
-        f.write(str(next_day))
+
+    mark_days_ingested(conn, day_str, user_ids_ingest, next_day)
     print(f"-> State updated. Next run will process day: {next_day}")
     return items_processed
 
@@ -452,44 +783,13 @@ def ingest_data(conn):
     
 
 if __name__ == "__main__":
-
-    # Setup Prometheus metrics and registry
-    error_registry = CollectorRegistry()
-    latency_registry = CollectorRegistry()
-    total_registry = CollectorRegistry()
-    throughput_registry = CollectorRegistry()
-    
-    INGESTION_LATENCY = Gauge(
-        'ingestion_latency_seconds', 
-        'Duration of the last ingestion job in seconds', 
-        registry=latency_registry
-    )
-    # Define the counter with a 'error_id' label
-    INGESTION_ERRORS = Counter('ingestion_errors_total', 
-                               'Total number of failed ingestion jobs', 
-                               ['error_id'], 
-                               registry=error_registry)
-    # A counter for total jobs attempted
-    INGESTION_JOBS_TOTAL = Counter(
-        'ingestion_jobs_total',
-        'Total number of ingestion jobs attempted',
-        registry=total_registry
-    )
-
-    # A gauge for throughput (e.g., items per second)
-    INGESTION_THROUGHPUT = Gauge(
-        'ingestion_throughput_items_per_second',
-        'Number of items processed per second in the last successful job',
-        registry=throughput_registry
-    )
+    # A single manual run that pushes its metrics to the Pushgateway; the ingestion
+    # service itself runs daemon.py, which keeps everything warm between runs
 
     start_time = time.time()
-    
+
     # Increment the total jobs counter at the start of every run
     INGESTION_JOBS_TOTAL.inc()
-    instance_id = datetime.now().isoformat()
-    push_to_gateway('pushgateway:9091', job='ingestion_job_total', registry=total_registry, grouping_key={'instance': instance_id} 
-                    if instance_id else {})
 
     db_url = os.getenv("DATABASE_URL")
     connection = None
@@ -510,21 +810,23 @@ if __name__ == "__main__":
         print("Could not connect to the database after several attempts. Exiting.")
         exit(1)
 
+    if not try_lock(connection):
+        print("Another ingestion run holds the lock. Exiting.")
+        connection.close()
+        exit(0)
+
     try:
         create_hypertable(connection)
-        items_processed = ingest_data(connection)
+        with worker_pools(db_url) as pools:
+            items_processed = ingest_data(connection, pools)
         duration = time.time() - start_time
         # Avoid division by zero if the job was instant
         throughput = items_processed / duration if duration > 0 else items_processed
         INGESTION_THROUGHPUT.set(throughput)
-        push_to_gateway('pushgateway:9091', job='ingestion_job_throughput', registry=throughput_registry)
+        INGESTION_LAST_SUCCESS.set_to_current_time()
     except Exception:
         # If any error occurs in the main block, increment the error counter
-        error_id = datetime.now().isoformat()
-        # Apply the unique label before incrementing
-        INGESTION_ERRORS.labels(error_id=error_id).inc()
-        push_to_gateway('pushgateway:9091', job='ingestion_job_errors', registry=error_registry, 
-                            grouping_key={'error_id': error_id} if error_id else {})
+        INGESTION_ERRORS.inc()
         print("A critical error occurred during ingestion:")
         traceback.print_exc()
     finally:
@@ -532,9 +834,9 @@ if __name__ == "__main__":
         duration = time.time() - start_time
         INGESTION_LATENCY.set(duration) # Set the gauge to the duration of this job
         try:
-            # Push all metrics from our custom registry to the Pushgateway
-            push_to_gateway('pushgateway:9091', job='ingestion_job_latency', registry=latency_registry)
-            print(f"Successfully pushed latency metric. Latency: {duration:.2f}s")
+            # One push of the whole registry under a fixed job name replaces the previous run's series
+            push_to_gateway('pushgateway:9091', job='ingestion_manual', registry=REGISTRY)
+            print(f"Successfully pushed ingestion metrics. Latency: {duration:.2f}s")
         except Exception as e:
             print(f"Failed to push metrics to Pushgateway: {e}")
         if connection:
@@ -0,0 +1,101 @@
+import contextlib
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+# Every ingestion metric lives in this one registry: daemon.py serves it on /metrics, and
+# one-shot runs of ingest.py and impute.py push it to the Pushgateway under a fixed job name.
+# Labels only take values from fixed sets (stage names, metric and table names, exception
+# classes), so the number of series stays the same however many runs there are.
+REGISTRY = CollectorRegistry()
+
+# fetch and parse are labelled with the wearipedia metric, load with the table written,
+# aggregate with the rollup table, gaps with data_gaps and impute with the imputed metric
+STAGE_SECONDS = Histogram(
+    'ingestion_stage_seconds',
+    'Time spent in each ingestion stage',
+    ['stage', 'metric'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+    registry=REGISTRY
+)
+STAGE_ROWS = Counter(
+    'ingestion_stage_rows_total',
+    'Rows produced by each ingestion stage (parsed, inserted, rolled up or imputed)',
+    ['stage', 'metric'],
+    registry=REGISTRY
+)
+STAGE_ERRORS = Counter(
+    'ingestion_stage_errors_total',
+    'Failures of each ingestion stage by exception class',
+    ['stage', 'error'],
+    registry=REGISTRY
+)
+STAGE_RETRIES = Counter(
+    'ingestion_stage_retries_total',
+    'Retried attempts of each ingestion stage after a transient database error',
+    ['stage'],
+    registry=REGISTRY
+)
+
+INGESTION_JOBS_TOTAL = Counter('ingestion_jobs_total', 'Total number of ingestion jobs attempted', registry=REGISTRY)
+INGESTION_ERRORS = Counter('ingestion_errors_total', 'Total number of failed ingestion jobs', registry=REGISTRY)
+INGESTION_LATENCY = Gauge('ingestion_latency_seconds', 'Duration of the last ingestion job in seconds', registry=REGISTRY)
+INGESTION_THROUGHPUT = Gauge(
+    'ingestion_throughput_items_per_second',
+    'Number of items processed per second in the last successful job',
+    registry=REGISTRY
+)
+INGESTION_LAST_SUCCESS = Gauge(
+    'ingestion_last_success_timestamp_seconds',
+    'Unix time the last successful job finished',
+    registry=REGISTRY
+)
+INGESTION_NEXT_DAY = Gauge('ingestion_next_day', 'Synthetic day the next run will ingest', registry=REGISTRY)
+
+
+@contextlib.contextmanager
+def stage(name, metric):
+    """Times a stage into ingestion_stage_seconds and counts its failures by exception class."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_ERRORS.labels(stage=name, error=type(e).__name__).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage=name, metric=metric).observe(time.perf_counter() - start)
+
+
+class StageLog:
+    """Collects stage timings in a worker process, where the registry is not the one served.
+
+    The log travels back with the worker's result and record() replays it into the
+    registry of the main process.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    @contextlib.contextmanager
+    def stage(self, name, metric):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.entries.append((name, metric, time.perf_counter() - start, 0, error))
+
+    def rows(self, name, metric, count):
+        self.entries.append((name, metric, None, count, None))
+
+    def record(self):
+        for name, metric, seconds, rows, error in self.entries:
+            if seconds is not None:
+                STAGE_SECONDS.labels(stage=name, metric=metric).observe(seconds)
+            if rows:
+                STAGE_ROWS.labels(stage=name, metric=metric).inc(rows)
+            if error is not None:
+                STAGE_ERRORS.labels(stage=name, error=error).inc()
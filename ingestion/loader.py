@@ -0,0 +1,166 @@
+import io
+import struct
+from datetime import date, datetime
+
+import numpy as np
+from psycopg2 import sql
+
+# Binary COPY framing: signature, flags and header extension length, and the end-of-data marker
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack(">h", -1)
+# Binary timestamps count microseconds from 2000-01-01
+PG_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
+
+# The hypertables store a metric_id from the metrics dictionary instead of the metric name.
+# Names a load has not seen yet are added first; the NOT EXISTS keeps known names from
+# drawing (and wasting) values of the smallint id sequence on every load.
+REGISTER_METRICS = """
+    INSERT INTO metrics (metric_name)
+    SELECT DISTINCT s.metric_name FROM {source} s
+    WHERE NOT EXISTS (SELECT 1 FROM metrics m WHERE m.metric_name = s.metric_name)
+    ON CONFLICT DO NOTHING;
+"""
+# Looks up the id of the metric name passed as a parameter
+METRIC_ID = "(SELECT metric_id FROM metrics WHERE metric_name = %s)"
+
+
+def format_copy_value(value):
+    """Formats one value for COPY's text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, float):
+        # Whole numbers are written without a fraction so INTEGER columns accept them, as an INSERT would
+        return str(int(value)) if value.is_integer() else str(value)
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    return str(value)
+
+
+def copy_buffer(rows):
+    """Renders rows as a COPY text-format buffer, one tab-separated line per row."""
+    buffer = io.StringIO()
+    buffer.writelines("\t".join(map(format_copy_value, row)) + "\n" for row in rows)
+    buffer.seek(0)
+    return buffer
+
+
+def load_rows(conn, table, columns, rows):
+    """Loads rows into table with COPY, skipping rows that conflict with existing ones.
+
+    Rows are streamed into a temporary staging table (temporary tables are never
+    WAL-logged) and merged with a single INSERT ... SELECT ... ON CONFLICT DO NOTHING,
+    which gives the same result as inserting them with execute_values. Returns the
+    number of new rows; the caller commits.
+    """
+    if not rows:
+        return 0
+    staging = sql.Identifier(f"staging_{table}")
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    with conn.cursor() as cur:
+        # Kept for the whole session and emptied on every commit, so repeated loads reuse it
+        cur.execute(sql.SQL(
+            "CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;"
+        ).format(staging=staging, table=sql.Identifier(table)))
+        cur.copy_expert(
+            sql.SQL("COPY {staging} ({columns}) FROM STDIN").format(staging=staging, columns=column_list),
+            copy_buffer(rows)
+        )
+        cur.execute(sql.SQL(
+            "INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT DO NOTHING;"
+        ).format(table=sql.Identifier(table), columns=column_list, staging=staging))
+        inserted = cur.rowcount
+        # Empty it right away in case the caller loads this table again before committing
+        cur.execute(sql.SQL("TRUNCATE {staging};").format(staging=staging))
+    return inserted
+
+
+def series_copy_buffer(batches):
+    """Renders SeriesBatches as a binary COPY buffer of (time, user_id, metric_name, value) rows.
+
+    Every row of a batch has the same layout, so each batch is written as one NumPy
+    structured array instead of formatting values one by one.
+    """
+    buffer = io.BytesIO()
+    buffer.write(COPY_BINARY_HEADER)
+    for batch in batches:
+        count = len(batch.times)
+        if not count:
+            continue
+        name = batch.metric_name.encode()
+        rows = np.empty(count, dtype=[
+            ("fields", ">i2"),
+            ("time_len", ">i4"), ("time", ">i8"),
+            ("user_len", ">i4"), ("user", ">i8"),
+            ("name_len", ">i4"), ("name", f"S{len(name)}"),
+            ("value_len", ">i4"), ("value", ">f8"),
+        ])
+        rows["fields"] = 4
+        rows["time_len"] = 8
+        rows["time"] = (batch.times.astype("datetime64[us]") - PG_EPOCH).astype(np.int64)
+        rows["user_len"] = 8
+        rows["user"] = batch.user_id
+        rows["name_len"] = len(name)
+        rows["name"] = name
+        rows["value_len"] = 8
+        rows["value"] = batch.values
+        buffer.write(rows.tobytes())
+    buffer.write(COPY_BINARY_TRAILER)
+    buffer.seek(0)
+    return buffer
+
+
+def load_series(conn, batches, imputed=False):
+    """Loads SeriesBatches into fitbit_data with binary COPY, skipping rows that already exist.
+
+    The staging time column is a plain timestamp, so the cast to timestamptz on merge uses the
+    session time zone exactly like the naive datetimes the tuple parsers produce. Metric names
+    are swapped for their metrics ids on merge. imputed sets is_imputed on every row. Returns
+    the number of new rows; the caller commits.
+    """
+    if not any(len(batch.times) for batch in batches):
+        return 0
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS staging_series (
+                time TIMESTAMP, user_id BIGINT, metric_name TEXT, value DOUBLE PRECISION
+            ) ON COMMIT DELETE ROWS;
+        """)
+        cur.copy_expert("COPY staging_series (time, user_id, metric_name, value) FROM STDIN WITH (FORMAT binary)",
+                        series_copy_buffer(batches))
+        cur.execute(REGISTER_METRICS.format(source="staging_series"))
+        cur.execute("""
+            INSERT INTO fitbit_data (time, user_id, metric_id, value, is_imputed)
+            SELECT s.time, s.user_id, m.metric_id, s.value, %s
+            FROM staging_series s JOIN metrics m ON m.metric_name = s.metric_name
+            ON CONFLICT DO NOTHING;
+        """, (imputed,))
+        inserted = cur.rowcount
+        cur.execute("TRUNCATE staging_series;")
+    return inserted
+
+
+def read_series(conn, user_id, metric_name, start, finish):
+    """Reads the ingested (not imputed) points of one fitbit_data series in [start, finish).
+
+    The rows come back with binary COPY and are decoded as one NumPy structured array, the
+    reverse of series_copy_buffer. Returns (times as UTC datetime64[us], float64 values).
+    """
+    buffer = io.BytesIO()
+    with conn.cursor() as cur:
+        query = cur.mogrify(f"""
+            COPY (
+                SELECT time, value FROM fitbit_data
+                WHERE user_id = %s AND metric_id = {METRIC_ID} AND is_imputed = FALSE AND time >= %s AND time < %s
+                ORDER BY time
+            ) TO STDOUT WITH (FORMAT binary)
+        """, (user_id, metric_name, start, finish))
+        cur.copy_expert(query.decode(), buffer)
+    data = buffer.getbuffer()[len(COPY_BINARY_HEADER):-len(COPY_BINARY_TRAILER)]
+    rows = np.frombuffer(data, dtype=[
+        ("fields", ">i2"),
+        ("time_len", ">i4"), ("time", ">i8"),
+        ("value_len", ">i4"), ("value", ">f8"),
+    ])
+    return PG_EPOCH + rows["time"].astype(np.int64).astype("timedelta64[us]"), rows["value"].astype(np.float64)
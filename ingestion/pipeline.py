@@ -0,0 +1,101 @@
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import psycopg2
+
+# Generic stages of the ingestion pipeline: fetch/parse -> batch -> load. Every stage is a
+# generator that only pulls from the one before it when it has room, so a slow loader
+# holds back parsing instead of letting parsed data pile up in memory.
+
+# Keys of a parsed chunk that hold rows for the database; SERIES holds SeriesBatches
+ROW_KEYS = ("fitbit_data", "daily_zones", "sleep_summary")
+SERIES = "series"
+
+
+def bounded_map(pool, func, items, limit):
+    """Yields func(item) for each item in completion order with at most limit calls in flight.
+
+    Items are pulled from the iterable only when a slot is free, so a lazy iterable
+    upstream is never read further ahead than limit items.
+    """
+    pending = set()
+    for item in items:
+        pending.add(pool.submit(func, item))
+        if len(pending) >= limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def empty_chunk():
+    return {key: [] for key in ROW_KEYS + (SERIES,)}
+
+
+def chunk_size(chunk):
+    return sum(len(chunk[key]) for key in ROW_KEYS) + sum(len(batch.times) for batch in chunk[SERIES])
+
+
+def split_chunk(chunk, batch_rows):
+    """Splits a parsed chunk into pieces of at most batch_rows rows, one table or series at a time."""
+    for key in ROW_KEYS:
+        rows = chunk[key]
+        for start in range(0, len(rows), batch_rows):
+            piece = empty_chunk()
+            piece[key] = rows[start:start + batch_rows]
+            yield piece
+    for batch in chunk[SERIES]:
+        for start in range(0, len(batch.times), batch_rows):
+            piece = empty_chunk()
+            piece[SERIES] = [batch._replace(times=batch.times[start:start + batch_rows],
+                                            values=batch.values[start:start + batch_rows])]
+            yield piece
+
+
+def batch_chunks(chunks, batch_rows):
+    """Regroups parsed chunks into batches of at most batch_rows rows each.
+
+    Small chunks (daily summaries, zones) are merged and large ones (a day of
+    per-second heart rate) are split, so every load writes a similar amount.
+    """
+    batch, size = empty_chunk(), 0
+    for chunk in chunks:
+        for piece in split_chunk(chunk, batch_rows):
+            piece_size = chunk_size(piece)
+            if size and size + piece_size > batch_rows:
+                yield batch
+                batch, size = empty_chunk(), 0
+            for key in ROW_KEYS + (SERIES,):
+                batch[key].extend(piece[key])
+            size += piece_size
+    if size:
+        yield batch
+
+
+class ConnectionPerThread:
+    """Gives every worker thread its own database connection and closes them all on exit."""
+
+    def __init__(self, db_url):
+        self.db_url = db_url
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            conn = psycopg2.connect(self.db_url)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for conn in self._connections:
+            conn.close()
@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta, timezone
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from instrumentation import STAGE_ROWS, stage
+
+# Rollup tiers, finest first. data_1m is computed from fitbit_data and every other tier from
+# the one before it, merging count/sum/min/max, so the raw data is only read once per bucket
+TIERS = [("data_1m", "1 minute", timedelta(minutes=1)),
+         ("data_1h", "1 hour", timedelta(hours=1)),
+         ("data_1d", "1 day", timedelta(days=1))]
+# time_bucket aligns minute, hour and day buckets to midnight UTC
+BUCKET_ORIGIN = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+FROM_RAW = """
+    SELECT time_bucket({width}, src.time), src.user_id, src.metric_id,
+           AVG(src.value), COUNT(src.value), SUM(src.value), MIN(src.value), MAX(src.value)
+"""
+FROM_TIER = """
+    SELECT time_bucket({width}, src.time), src.user_id, src.metric_id,
+           SUM(src.sum_value) / SUM(src.sample_count), SUM(src.sample_count),
+           SUM(src.sum_value), MIN(src.min_value), MAX(src.max_value)
+"""
+ROLLUP_QUERY = """
+    INSERT INTO {table} (time, user_id, metric_id, avg_value, sample_count, sum_value, min_value, max_value)
+    {select}
+    FROM unnest(%s::bigint[], %s::text[], %s::timestamptz[], %s::timestamptz[]) AS d(user_id, metric_name, start_time, end_time)
+    JOIN metrics m ON m.metric_name = d.metric_name
+    JOIN {source} src ON src.user_id = d.user_id AND src.metric_id = m.metric_id
+        AND src.time >= d.start_time AND src.time < d.end_time
+    {where}
+    GROUP BY 1, 2, 3
+    ON CONFLICT (time, user_id, metric_id) DO UPDATE
+    SET avg_value = EXCLUDED.avg_value,
+        sample_count = EXCLUDED.sample_count,
+        sum_value = EXCLUDED.sum_value,
+        min_value = EXCLUDED.min_value,
+        max_value = EXCLUDED.max_value;
+"""
+
+
+def dirty_ranges(batch):
+    """(user_id, metric_name, first time, last time) of every series a load batch writes to fitbit_data."""
+    ranges = {}
+
+    def extend(key, first, last):
+        if key in ranges:
+            first, last = min(first, ranges[key][0]), max(last, ranges[key][1])
+        ranges[key] = (first, last)
+
+    for series in batch["series"]:
+        if len(series.times):
+            extend((series.user_id, series.metric_name),
+                   series.times.min().astype("datetime64[us]").item(), series.times.max().astype("datetime64[us]").item())
+    for time, user_id, metric_name, _ in batch["fitbit_data"]:
+        extend((user_id, metric_name), time, time)
+    return [(user_id, metric_name, first, last) for (user_id, metric_name), (first, last) in ranges.items()]
+
+
+def mark_dirty(cur, batch):
+    """Queues the ranges a batch touches for the next refresh; runs in the batch's transaction."""
+    ranges = dirty_ranges(batch)
+    if ranges:
+        execute_values(cur, "INSERT INTO rollup_dirty (user_id, metric_name, start_time, end_time) VALUES %s;", ranges)
+
+
+def bucket_floor(time, width):
+    return BUCKET_ORIGIN + (time - BUCKET_ORIGIN) // width * width
+
+
+def coalesce(dirty, width):
+    """Widens dirty ranges to whole buckets and merges overlapping ones per series.
+
+    Merged ranges never overlap, so joining them against the source table reads every
+    row at most once.
+    """
+    merged = []
+    widened = sorted((user_id, metric_name, bucket_floor(start, width), bucket_floor(end, width) + width)
+                     for user_id, metric_name, start, end in dirty)
+    for user_id, metric_name, start, end in widened:
+        if merged and merged[-1][:2] == [user_id, metric_name] and start <= merged[-1][3]:
+            merged[-1][3] = max(merged[-1][3], end)
+        else:
+            merged.append([user_id, metric_name, start, end])
+    return merged
+
+
+def drain_dirty(cur, user_ids=None, start=None, end=None):
+    """Takes the queued dirty ranges off rollup_dirty: every one, or only those of user_ids that overlap [start, end).
+
+    Run it in the refresh's transaction, so if the refresh fails the ranges stay queued
+    for the next one.
+    """
+    if user_ids is None:
+        cur.execute("DELETE FROM rollup_dirty RETURNING user_id, metric_name, start_time, end_time;")
+    else:
+        # end_time is the last point of a range, not past it
+        cur.execute("""
+            DELETE FROM rollup_dirty
+            WHERE user_id = ANY(%s) AND start_time < %s AND end_time >= %s
+            RETURNING user_id, metric_name, start_time, end_time;
+        """, (user_ids, end, start))
+    return cur.fetchall()
+
+
+def refresh_rollups(cur, dirty):
+    """Recomputes the rollup buckets covering the dirty ranges, tier by tier; returns the rows written per tier."""
+    rows = {}
+    source = "fitbit_data"
+    for table, width, step in TIERS:
+        ranges = coalesce(dirty, step)
+        if not ranges:
+            rows[table] = 0
+        else:
+            query = sql.SQL(ROLLUP_QUERY).format(
+                table=sql.Identifier(table),
+                select=sql.SQL(FROM_RAW if source == "fitbit_data" else FROM_TIER).format(width=sql.Literal(width)),
+                source=sql.Identifier(source),
+                # Imputed points are left out of the rollups
+                where=sql.SQL("WHERE src.is_imputed = FALSE" if source == "fitbit_data" else "")
+            )
+            with stage("aggregate", table):
+                cur.execute(query, [list(column) for column in zip(*ranges)])
+            rows[table] = cur.rowcount
+            STAGE_ROWS.labels(stage="aggregate", metric=table).inc(rows[table])
+        print(f"Recomputed {rows[table]} rows of {table} over {len(ranges)} dirty range(s).")
+        source = table
+    return rows
@@ -1,4 +0,0 @@
-#!/bin/bash
-# Load environment variables and run the Python script
-source /etc/environment
-exec /usr/local/bin/python /app/ingest.py
\ No newline at end of file
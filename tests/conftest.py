@@ -0,0 +1,9 @@
+# The ingestion scripts and the backend modules import each other as top-level modules, and
+# impute.py sits at the repository root here and next to them in the containers
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "ingestion"))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
@@ -0,0 +1,61 @@
+from datetime import date, datetime, timezone
+
+from starlette.responses import Response
+
+from cache import MemoryBackend, ResponseCache
+
+JAN_1, JAN_2, JAN_3 = date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 3)
+
+
+def at(hour):
+    return datetime(2024, 2, 1, hour, tzinfo=timezone.utc)
+
+
+def cache_with(rows):
+    cache = ResponseCache(MemoryBackend())
+    cache.apply_watermarks(rows, None)
+    return cache
+
+
+def put(cache, key, user_ids, start, end):
+    return cache.put(key, Response(b"{}", media_type="application/json"), user_ids, start, end, cache.watermark())
+
+
+def test_fresh_entry_is_served():
+    cache = cache_with([(1, JAN_1, at(1))])
+    put(cache, "k", [1], JAN_1, JAN_2)
+    assert cache.get("/data", "k") is not None
+
+
+def test_reingested_day_makes_entry_stale():
+    cache = cache_with([(1, JAN_1, at(1)), (1, JAN_2, at(1))])
+    entry = put(cache, "k", [1], JAN_1, JAN_2)
+    cache.apply_watermarks([(1, JAN_2, at(2))], at(1))
+    assert cache._is_stale(entry)
+    assert cache.get("/data", "k") is None
+
+
+def test_other_days_and_users_keep_entry():
+    cache = cache_with([(1, JAN_1, at(1)), (2, JAN_1, at(1))])
+    entry = put(cache, "k", [1], JAN_1, JAN_2)
+    # Outside the entry's range, or another user's day
+    cache.apply_watermarks([(1, JAN_3, at(2)), (2, JAN_1, at(2))], at(1))
+    assert not cache._is_stale(entry)
+    assert cache.get("/data", "k") is not None
+
+
+def test_day_ingested_while_building_makes_entry_stale():
+    cache = cache_with([(1, JAN_1, at(1))])
+    watermark = cache.watermark()
+    # Ingestion commits and is polled between taking the watermark and storing the response
+    cache.apply_watermarks([(1, JAN_1, at(2))], at(1))
+    entry = cache.put("k", Response(b"{}"), [1], JAN_1, JAN_1, watermark)
+    assert cache._is_stale(entry)
+
+
+def test_entry_without_watermark_goes_stale_on_first_ingest():
+    cache = ResponseCache(MemoryBackend())
+    entry = put(cache, "k", [1], JAN_1, JAN_1)
+    assert entry["watermark"] is None and not cache._is_stale(entry)
+    cache.apply_watermarks([(1, JAN_1, at(1))], None)
+    assert cache._is_stale(entry)
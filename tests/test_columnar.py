@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+import ingest
+from columnar import SeriesBatch, batches_to_rows, clock_seconds, day_times, rows_to_batches
+
+USER_ID = 7
+
+
+def heart_rate_day(date_str, dataset):
+    return {"heart_rate_day": [{
+        "activities-heart": [{"dateTime": date_str, "value": {}}],
+        "activities-heart-intraday": {"dataset": dataset},
+    }]}
+
+
+def assert_same_rows(tuple_parser, columnar_parser, records):
+    expected = tuple_parser(records, USER_ID)
+    batches = columnar_parser(records, USER_ID)
+    assert all(isinstance(batch, SeriesBatch) for batch in batches)
+    assert sorted(batches_to_rows(batches)) == sorted(expected)
+    return expected
+
+
+HEART_RATE_CASES = {
+    "regular": [heart_rate_day("2024-01-01", [{"time": "00:00:00", "value": 61}, {"time": "23:59:59", "value": 72}])],
+    # Not all HH:MM:SS, so the whole day goes through parse_timestamps
+    "irregular clocks": [heart_rate_day("2024-01-02", [{"time": "08:30", "value": 80},
+                                                       {"time": "08:30:15.500", "value": 81},
+                                                       {"time": "08:31:00", "value": 82}])],
+    "empty days": [heart_rate_day("2024-01-03", []), heart_rate_day(None, [{"time": "00:00:01", "value": 60}]),
+                   {}, heart_rate_day("2024-01-04", [{"time": "12:00:00", "value": 90}])],
+}
+
+
+@pytest.mark.parametrize("case", HEART_RATE_CASES)
+def test_heart_rate_matches_tuple_parser(case):
+    assert_same_rows(ingest.parse_heart_rate, ingest.parse_heart_rate_columns, HEART_RATE_CASES[case])
+
+
+def test_heart_rate_keeps_fractional_seconds():
+    rows = batches_to_rows(ingest.parse_heart_rate_columns(HEART_RATE_CASES["irregular clocks"], USER_ID))
+    assert sorted(row[0].microsecond for row in rows) == [0, 0, 500000]
+
+
+def test_heart_rate_rejects_bad_time_like_tuple_parser():
+    records = [heart_rate_day("2024-01-01", [{"time": "00:00:00", "value": 61}, {"time": "25:00:00", "value": 62}])]
+    with pytest.raises(ValueError):
+        ingest.parse_heart_rate(records, USER_ID)
+    with pytest.raises(ValueError):
+        ingest.parse_heart_rate_columns(records, USER_ID)
+
+
+SPO2_CASES = {
+    "regular": [{"dateTime": "2024-01-01", "minutes": [{"minute": "2024-01-01T00:00:00", "value": 97.5},
+                                                       {"minute": "2024-01-01T00:01:00", "value": 96}]}],
+    "fractional seconds": [{"dateTime": "2024-01-01", "minutes": [{"minute": "2024-01-01T00:00:00.250", "value": 95}]}],
+    "empty days": [{"dateTime": "2024-01-02", "minutes": []}, {"minutes": [{"minute": "2024-01-03T00:00:00", "value": 90}]},
+                   {"dateTime": "2024-01-04", "minutes": [{"minute": "2024-01-04T06:00:00", "value": 98}]}],
+}
+
+
+@pytest.mark.parametrize("case", SPO2_CASES)
+def test_spo2_matches_tuple_parser(case):
+    assert_same_rows(ingest.parse_spo2, ingest.parse_spo2_columns, SPO2_CASES[case])
+
+
+def azm_day(date_str, minutes):
+    return {"activities-active-zone-minutes-intraday": [{"dateTime": date_str, "minutes": minutes}]}
+
+
+AZM_CASES = {
+    # A missing type counts as 0 minutes, an explicit null is skipped
+    "missing values": [azm_day("2024-01-01", [
+        {"minute": "00:00:00", "value": {"activeZoneMinutes": 2, "fatBurnActiveZoneMinutes": 2}},
+        {"minute": "00:01:00", "value": {"activeZoneMinutes": 1, "cardioActiveZoneMinutes": None}},
+        {"minute": "00:02:00", "value": {"peakActiveZoneMinutes": None, "activeZoneMinutes": None}},
+        {"minute": "00:03:00", "value": {}},
+        {"minute": None, "value": {"activeZoneMinutes": 5}},
+        {"value": {"activeZoneMinutes": 5}},
+    ])],
+    "irregular clocks": [azm_day("2024-01-01", [{"minute": "00:00", "value": {"activeZoneMinutes": 1}},
+                                                {"minute": "00:01:00", "value": {"activeZoneMinutes": 2}}])],
+    # Points whose time does not parse are skipped, the rest of the day is kept
+    "bad clock": [azm_day("2024-01-01", [{"minute": "00:00:00", "value": {"activeZoneMinutes": 1}},
+                                         {"minute": "99:00", "value": {"activeZoneMinutes": 2}}])],
+    "empty days": [azm_day("2024-01-01", []), azm_day(None, [{"minute": "00:00:00", "value": {"activeZoneMinutes": 1}}]),
+                   {"activities-active-zone-minutes-intraday": []}, {}],
+}
+
+
+@pytest.mark.parametrize("case", AZM_CASES)
+def test_azm_matches_tuple_parser(case):
+    assert_same_rows(ingest.parse_azm, ingest.parse_azm_columns, AZM_CASES[case])
+
+
+def test_clock_seconds():
+    assert clock_seconds(["00:00:00", "01:02:03", "23:59:59"]).tolist() == [0, 3723, 86399]
+    for clocks in (["08:30"], ["08:30:00", "08:30"], ["08:30:15.500"], ["24:00:00"], ["ab:cd:ef"], ["08-30-00"]):
+        assert clock_seconds(clocks) is None
+
+
+def test_day_times_masks_unparsed_clocks():
+    times, valid = day_times("2024-01-01", ["08:30", "nope", "09:00:00"])
+    assert valid.tolist() == [True, False, True]
+    assert times[valid].astype("datetime64[s]").astype(str).tolist() == ["2024-01-01T08:30:00", "2024-01-01T09:00:00"]
+
+
+def test_rows_to_batches_round_trip():
+    hrv = [{"hrv": [{"minutes": [
+        {"minute": "2024-01-01T00:00:00.000", "value": {"rmssd": 40.5, "coverage": 0.9, "hf": 120.0, "lf": 300.0}},
+        {"minute": "2024-01-01T00:05:00.000", "value": {"rmssd": 41.0, "coverage": None, "hf": None, "lf": 310.0}},
+    ]}]}]
+    rows = ingest.parse_spo2(SPO2_CASES["regular"], USER_ID) + ingest.parse_hrv(hrv, USER_ID)
+    batches = rows_to_batches(rows)
+    assert {(batch.user_id, batch.metric_name) for batch in batches} == {(row[1], row[2]) for row in rows}
+    assert all(batch.times.dtype == np.dtype("datetime64[us]") for batch in batches)
+    assert sorted(batches_to_rows(batches)) == sorted(rows)
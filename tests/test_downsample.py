@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from downsample import downsample_rows, lttb_indices
+
+
+def make_rows(count):
+    start = datetime(2024, 1, 1)
+    values = np.random.default_rng(0).normal(75, 12, count)
+    return [(start + timedelta(seconds=i), float(values[i]), 1) for i in range(count)]
+
+
+@pytest.mark.parametrize("count, max_points", [(1000, 3), (1000, 100), (1001, 999), (10, 9)])
+def test_keeps_endpoints_within_budget(count, max_points):
+    rows = make_rows(count)
+    sampled = downsample_rows(rows, max_points)
+    assert len(sampled) == max_points
+    assert sampled[0] is rows[0] and sampled[-1] is rows[-1]
+    # Rows are picked in order, each at most once
+    times = [row[0] for row in sampled]
+    assert times == sorted(set(times))
+
+
+def test_short_series_untouched():
+    rows = make_rows(50)
+    assert downsample_rows(rows, 50) is rows
+    assert downsample_rows(rows, 500) is rows
+
+
+def test_keeps_spike():
+    # One spike in an otherwise flat series makes the largest triangle of its bucket
+    y = np.zeros(1000)
+    y[437] = 100
+    indices = lttb_indices(np.arange(1000), y, 50)
+    assert 437 in indices.tolist()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from fill import STRATEGIES, fill_gaps, impute_series, run_lengths
+
+NAN = np.nan
+
+
+def test_linear():
+    means = np.array([NAN, 1.0, NAN, NAN, 4.0, NAN])
+    positions, filled = fill_gaps(means, "linear", np.arange(6))
+    # Only between the first and the last non-empty bucket
+    assert positions.tolist() == [2, 3]
+    assert filled[positions].tolist() == [2.0, 3.0]
+
+
+def test_locf():
+    means = np.array([1.0, NAN, NAN, 5.0, NAN, 7.0])
+    positions, filled = fill_gaps(means, "locf", np.arange(6))
+    assert positions.tolist() == [1, 2, 4]
+    assert filled[positions].tolist() == [1.0, 1.0, 5.0]
+
+
+def test_seasonal():
+    # Two days of four slots; a bucket takes the mean of its slot over the other days
+    means = np.array([1.0, 10.0, 20.0, 3.0,
+                      5.0, NAN, 40.0, 7.0])
+    positions, filled = fill_gaps(means, "seasonal", np.tile(np.arange(4), 2))
+    assert positions.tolist() == [5]
+    assert filled[5] == 10.0
+
+
+def test_seasonal_leaves_slots_never_seen():
+    means = np.array([1.0, NAN, 3.0, 5.0, NAN, 7.0])
+    positions, _ = fill_gaps(means, "seasonal", np.tile(np.arange(3), 2))
+    assert positions.tolist() == []
+
+
+@pytest.mark.parametrize("strategy", STRATEGIES)
+@pytest.mark.parametrize("max_gap, expected", [(0, [1, 3, 4, 6, 7, 8]), (1, [1]), (2, [1, 3, 4]), (3, [1, 3, 4, 6, 7, 8])])
+def test_max_gap(strategy, max_gap, expected):
+    # Runs of 1, 2 and 3 empty buckets, every slot seen so seasonal can fill them all
+    means = np.array([1.0, NAN, 2.0, NAN, NAN, 3.0, NAN, NAN, NAN, 4.0])
+    slots = np.zeros(len(means), dtype=np.int64)
+    positions, filled = fill_gaps(means, strategy, slots, max_gap)
+    assert positions.tolist() == expected
+    assert not np.isnan(filled[positions]).any()
+
+
+def test_too_few_points():
+    for means in (np.array([NAN, NAN]), np.array([NAN, 2.0, NAN])):
+        positions, _ = fill_gaps(means, "linear", np.arange(len(means)))
+        assert positions.tolist() == []
+
+
+def test_run_lengths():
+    missing = np.array([False, True, True, False, True, False, True, True, True])
+    assert run_lengths(missing).tolist() == [0, 2, 2, 0, 1, 0, 3, 3, 3]
+
+
+def test_impute_series_buckets_and_window():
+    origin = np.datetime64("2024-01-01T00:00:00", "us")
+    step = np.timedelta64(60, "s").astype("timedelta64[us]")
+    # Two points in the first minute are averaged; minutes 1-2 and 4 are empty
+    offsets = np.array([0, 30, 180, 300], dtype="timedelta64[s]")
+    times = origin + offsets.astype("timedelta64[us]")
+    values = np.array([1.0, 3.0, 5.0, 9.0])
+    start = origin + 2 * step
+    imputed_times, imputed_values = impute_series(times, values, origin, start, origin + 6 * step, step, "linear")
+    # Minute 1 lies before the window's start and is not returned
+    assert imputed_times.tolist() == [start.item(), (origin + 4 * step).item()]
+    assert imputed_values.tolist() == [4.0, 7.0]
@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from resolution import native_granularity, plan_resolution
+
+START = datetime(2024, 1, 1)
+
+
+@pytest.mark.parametrize("metrics, span, budget, table, interval", [
+    # 1-second heart rate: raw for an hour, then ever coarser rollups as the range grows
+    (["intraday_heart_rate"], timedelta(hours=1), 5000, "fitbit_data", "1 second"),
+    (["intraday_heart_rate"], timedelta(days=1), 5000, "data_1m", "1 minute"),
+    (["intraday_heart_rate"], timedelta(days=30), 5000, "data_1h", "1 hour"),
+    (["intraday_heart_rate"], timedelta(days=3650), 5000, "data_1d", "1 day"),
+    # 1-minute SpO2 is no finer in fitbit_data than in data_1m, so the rollup is read
+    (["intraday_spo2"], timedelta(days=1), 5000, "data_1m", "1 minute"),
+    # Daily metrics are daily everywhere: the smallest table wins
+    (["breathing_rate_full"], timedelta(days=30), 5000, "data_1d", "1 day"),
+    # Several metrics are planned for the finest of them
+    (["breathing_rate_full", "intraday_heart_rate"], timedelta(hours=1), 5000, "fitbit_data", "1 second"),
+    # Metrics without a config are treated as 1-second series
+    (["unknown_metric"], timedelta(minutes=10), 5000, "fitbit_data", "1 second"),
+    # Nothing fits: the coarsest tier
+    (["intraday_heart_rate"], timedelta(days=3650), 10, "data_1d", "1 day"),
+])
+def test_plan_resolution(metrics, span, budget, table, interval):
+    resolution = plan_resolution(START, START + span, metrics, budget)
+    assert (resolution.table, resolution.interval) == (table, interval)
+
+
+def test_estimate_stays_within_budget():
+    resolution = plan_resolution(START, START + timedelta(days=1), ["intraday_heart_rate"], 5000)
+    assert resolution.estimated_points == 24 * 60 + 1 <= 5000
+    assert resolution.value_column == "avg_value"
+
+
+def test_native_granularity():
+    assert native_granularity("intraday_spo2") == timedelta(minutes=1)
+    assert native_granularity("unknown_metric") == timedelta(seconds=1)